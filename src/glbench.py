@@ -0,0 +1,328 @@
+import argparse
+import io
+import os
+import random
+import tempfile
+import timeit
+
+from golib.config.golib_conf import gsize, B, W
+from golib.model import Kifu, Move, Rule, RuleUnsafe, BitRuleUnsafe, StateError, SgfWarning, CollectionGl, TK_TYPE
+from golib.model import arrays, batch, sgf, sgf_ck, packing
+
+
+"""
+Performance measurements entry point. Not needed by the application itself.
+
+Each benchmark runs on synthetic games by default, or on the SGF files provided on the command line.
+
+"""
+
+
+def get_argparser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(conflict_handler='resolve')
+    parser.add_argument("bench", nargs="*", help="Benchmarks to run (default: all). One of: " + ", ".join(BENCHES))
+    parser.add_argument("--sgf", nargs="*", default=[], help="SGF files to use instead of synthetic games.")
+    parser.add_argument("--games", type=int, default=20, help="Number of synthetic games to generate.")
+    parser.add_argument("--batch-games", type=int, default=300,
+                        help="Number of synthetic games to generate for the batch benchmark, which needs more games than "
+                             "the others to pay off (see golib.model.batch).")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of timing repetitions (the best is kept).")
+    return parser
+
+
+def random_moves(length, seed=0, area=gsize):
+    """ Return a list of legal moves, picked randomly in the area x area corner of the goban.
+
+    The smaller the area, the more captures.
+    """
+    rand = random.Random(seed)
+    rule = RuleUnsafe()
+    moves = []
+    color = B
+    attempts = 0
+    while len(moves) < length and attempts < 50 * length:
+        attempts += 1
+        move = Move(TK_TYPE, (color, rand.randrange(area), rand.randrange(area)), number=len(moves) + 1)
+        try:
+            rule.put(move, reset=False)
+        except StateError:
+            rule.reset()
+            continue
+        rule.confirm()
+        moves.append(move)
+        color = W if color == B else B
+    return moves
+
+
+def random_sgf(length=250, comment=2000, seed=0, area=gsize):
+    """ Return the SGF text of a random game, where each move is annotated with a long comment.
+    """
+    rand = random.Random(seed)
+    kifu = Kifu(log=lambda _: None)
+    for move in random_moves(length, seed=seed, area=area):
+        kifu.append(move)
+        words = [rand.choice(("atari", "tesuji", "[joseki]", "aji", "C:\\path", "moyo\n")) for _ in range(comment // 6)]
+        kifu[-1].properties['C'] = [" ".join(words)]
+    f = io.StringIO()
+    kifu.game.output(f)
+    return f.getvalue()
+
+
+def corpus(args, games=None):
+    if args.sgf:
+        texts = []
+        for path in args.sgf:
+            with open(path) as f:
+                texts.append(f.read())
+        return texts
+    return [random_sgf(seed=i) for i in range(args.games if games is None else games)]
+
+
+def mainline_moves(text):
+    """ Return the moves of the main line of the first game of the SGF text.
+    """
+    moves = []
+    for node in packing.mainline(sgf_ck.build_collection(text)[0]):
+        try:
+            move = node.getmove()
+        except SgfWarning:
+            continue
+        if move is not None:
+            moves.append(move)
+    return moves
+
+
+def dump(collection):
+    f = io.StringIO()
+    collection.output(f)
+    return f.getvalue()
+
+
+def bench_parse(args):
+    """ Compare Tauber's character-level parser with the bulk lexer.
+    """
+    texts = corpus(args)
+
+    def parse_with(parser_class):
+        collections = []
+        for text in texts:
+            parser = parser_class()
+            collection = CollectionGl(parser)
+            parser.parse(text)
+            collections.append(collection)
+        return collections
+
+    for old, new in zip(parse_with(sgf.Parser), parse_with(sgf_ck.Parser)):
+        assert dump(old) == dump(new), "The parsers disagree"
+    report("parse", texts, {
+        "sgf.Parser": lambda: parse_with(sgf.Parser),
+        "sgf_ck.Parser": lambda: parse_with(sgf_ck.Parser),
+    }, args.repeat)
+
+
+def bench_build(args):
+    """ Compare building trees through parser callbacks and directly from the tokens.
+    """
+    texts = corpus(args)
+
+    def parse_callbacks():
+        collections = []
+        for text in texts:
+            parser = sgf_ck.Parser()
+            collection = CollectionGl(parser)
+            parser.parse(text)
+            collections.append(collection)
+        return collections
+
+    def build():
+        return [sgf_ck.build_collection(text) for text in texts]
+
+    for old, new in zip(parse_callbacks(), build()):
+        assert dump(old) == dump(new), "The loaders disagree"
+    report("build", texts, {
+        "callbacks": parse_callbacks,
+        "build_collection": build,
+    }, args.repeat)
+
+
+def bench_output(args):
+    """ Compare Tauber's element-by-element output with the buffered SgfWriter.
+    """
+    texts = corpus(args)
+    games = []
+    for text in texts:
+        parser = sgf_ck.Parser()
+        collection = CollectionGl(parser)
+        parser.parse(text)
+        games.append(collection[0])
+
+    def output_with(func):
+        for game in games:
+            func(game, io.StringIO())
+
+    for game in games:
+        old, new = io.StringIO(), io.StringIO()
+        sgf.GameTree.output(game, old)
+        game.output(new)
+        assert old.getvalue() == new.getvalue(), "The outputs differ"
+    report("output", texts, {
+        "sgf.GameTree.output": lambda: output_with(sgf.GameTree.output),
+        "SgfWriter": lambda: output_with(lambda game, f: game.output(f)),
+        "SgfWriter (compact)": lambda: output_with(lambda game, f: game.output(f, compact=True)),
+    }, args.repeat)
+
+
+def bench_packing(args):
+    """ Compare loading games from SGF files and from packed files.
+    """
+    texts = corpus(args)
+    with tempfile.TemporaryDirectory() as tmp:
+        sgf_files, packed_files = [], []
+        for i, text in enumerate(texts):
+            path = os.path.join(tmp, "{0}.sgf".format(i))
+            with open(path, 'w') as f:
+                f.write(text)
+            sgf_files.append(path)
+            packed_files.append(path.replace(".sgf", packing.PACKED_EXT))
+            with open(packed_files[-1], 'wb') as f:
+                packing.dump(Kifu(path, log=lambda _: None).game, f)  # the comments are dropped
+        report("packing", texts, {
+            "Kifu(.sgf)": lambda: [Kifu(path, log=lambda _: None) for path in sgf_files],
+            "Kifu(" + packing.PACKED_EXT + ")": lambda: [Kifu(path, log=lambda _: None) for path in packed_files],
+        }, args.repeat)
+
+
+def bench_rules(args):
+    """ Measure the throughput of put() and remove(), either confirmed one move at a time or in a row.
+    """
+    texts = corpus(args)
+    games = [mainline_moves(text) for text in texts]
+
+    def put_with(rule_class, confirm):
+        rules = []
+        for moves in games:
+            rule = rule_class()
+            for move in moves:
+                if confirm:
+                    rule.put(move)
+                    rule.confirm()
+                else:
+                    rule.put(move, reset=False)
+            rule.confirm()
+            rules.append(rule)
+        return rules
+
+    played = put_with(RuleUnsafe, True)
+
+    def remove_all(confirm):
+        for rule, moves in zip(played, games):
+            rule = rule.copy()
+            for move in reversed(moves):
+                if confirm:
+                    rule.remove(move)
+                    rule.confirm()
+                else:
+                    rule.remove(move, reset=False)
+            rule.confirm()
+
+    report("rules put", texts, {
+        "put + confirm": lambda: put_with(RuleUnsafe, True),
+        "put": lambda: put_with(RuleUnsafe, False),
+        "Rule put + confirm": lambda: put_with(Rule, True),
+    }, args.repeat)
+    report("rules remove", texts, {
+        "remove + confirm": lambda: remove_all(True),
+        "remove": lambda: remove_all(False),
+    }, args.repeat)
+
+
+def bench_bits(args):
+    """ Compare the rules engines (chains or bitsets), on the corpus and on synthetic games full of captures.
+    """
+    def put_all(rule_class, games):
+        for moves in games:
+            rule = rule_class()
+            for move in moves:
+                rule.put(move)
+                rule.confirm()
+
+    def remove_all(played, games):
+        for rule, moves in zip(played, games):
+            rule = rule.copy()
+            for move in reversed(moves):
+                rule.remove(move)
+                rule.confirm()
+
+    captures = [random_sgf(comment=0, seed=i, area=9) for i in range(args.games)]
+    for name, texts in (("corpus", corpus(args)), ("captures", captures)):
+        games = [mainline_moves(text) for text in texts]
+        played = {}
+        for rule_class in (RuleUnsafe, BitRuleUnsafe):
+            played[rule_class] = []
+            for moves in games:
+                rule = rule_class()
+                for move in moves:
+                    rule.put(move, reset=False)
+                rule.confirm()
+                played[rule_class].append(rule)
+        report("bits put, " + name, texts, {
+            "RuleUnsafe": lambda: put_all(RuleUnsafe, games),
+            "BitRuleUnsafe": lambda: put_all(BitRuleUnsafe, games),
+        }, args.repeat)
+        report("bits remove, " + name, texts, {
+            "RuleUnsafe": lambda: remove_all(played[RuleUnsafe], games),
+            "BitRuleUnsafe": lambda: remove_all(played[BitRuleUnsafe], games),
+        }, args.repeat)
+
+
+def bench_batch(args):
+    """ Compare checking the rules of whole games one game at a time, and all games at once with NumPy.
+    """
+    if batch.numpy is None:
+        print("batch: skipped, NumPy is not installed")
+        return
+    texts = corpus(args, games=args.batch_games)
+    games = [mainline_moves(text) for text in texts]
+    offsets, flat = arrays.dump_collection(sgf_ck.build_collection(text)[0] for text in texts)
+
+    def check_each():
+        for moves in games:
+            rule = RuleUnsafe()
+            try:
+                for move in moves:
+                    rule.put(move, reset=False)
+            except StateError:
+                pass
+
+    report("batch", texts, {
+        "RuleUnsafe per game": check_each,
+        "check_collection": lambda: batch.check_collection(offsets, flat),
+    }, args.repeat)
+
+
+def report(name, texts, candidates, repeat):
+    size = sum(len(text) for text in texts)
+    print("{0}: {1} games, {2:.1f} MB".format(name, len(texts), size / 1e6))
+    reference = None
+    for label, func in candidates.items():
+        best = min(timeit.repeat(func, number=1, repeat=repeat))
+        if reference is None:
+            reference = best
+        print("    {0:<24} {1:8.3f}s   x{2:.1f}".format(label, best, reference / best))
+
+
+BENCHES = {
+    "parse": bench_parse,
+    "build": bench_build,
+    "output": bench_output,
+    "packing": bench_packing,
+    "rules": bench_rules,
+    "bits": bench_bits,
+    "batch": bench_batch,
+}
+
+
+if __name__ == '__main__':
+    arguments = get_argparser().parse_args()
+    for bench in arguments.bench or BENCHES:
+        BENCHES[bench](arguments)
@@ -0,0 +1,30 @@
+import argparse
+import sys
+import time
+
+from golib.model import indexer
+
+
+"""
+Headless entry point: index the SGF files of one or several directories.
+
+"""
+
+
+def get_argparser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(conflict_handler='resolve')
+    parser.add_argument("dirs", nargs="+", help="Directories to search for SGF files, recursively.")
+    parser.add_argument("--output", default="index.jsonl", help="The index file to write (one JSON array per game).")
+    parser.add_argument("--moves", type=int, default=20, help="Number of opening moves to record per game.")
+    parser.add_argument("--processes", type=int, default=None, help="Number of worker processes (default: all cores).")
+    return parser
+
+
+if __name__ == '__main__':
+    args = get_argparser().parse_args()
+    start = time.time()
+    with open(args.output, 'w') as out:
+        indexed, failed = indexer.build_index(args.dirs, out, nb_moves=args.moves, processes=args.processes)
+    print("Indexed {0} games in {1:.1f}s to '{2}'".format(indexed, time.time() - start, args.output))
+    if failed:
+        sys.stderr.write("{0} files could not be read\n".format(failed))
@@ -10,6 +10,9 @@ B = 'B'
 W = 'W'
 E = 'E'
 
+# the superko rule enforced when playing: None (basic ko only), "positional" or "situational"
+superko = None
+
 # width of the screen, pixels
 screenw = 1280
 
@@ -12,15 +12,21 @@ class ControllerBase:
     """
     Provide Go-related controls only (no GUI).
 
+    The state of the goban is saved every checkpoint_interval moves when browsing the game (see goto()), so that any
+    move can be reached by replaying at most checkpoint_interval moves. The checkpoints following an edit are dropped.
+
     """
 
+    checkpoint_interval = 20
+
     def __init__(self, sgffile=None):
         # temporary log implementation that will hopefully be changed for a more decent framework
         self.log = lambda msg: sys.stdout.write(str(msg) + "\n")
         self.err = lambda msg: sys.stderr.write(str(msg) + "\n")
         self.kifu = Kifu(sgffile=sgffile, log=self.log, err=self.err)
-        self.rules = Rule()
+        self.rules = Rule(superko=golib_conf.superko)
         self.head = 0
+        self.checkpoints = {}  # move number -> snapshot of self.rules after that move
 
     def loadkifu(self, sfile=None):
         self.kifu = Kifu(sgffile=sfile, log=self.log, err=self.err)
@@ -31,11 +37,15 @@ class ControllerBase:
                 self.log("New game")
         self.rules.clear()
         self.head = 0
+        self.checkpoints.clear()
         return sfile
 
     def goto(self, move_nr):
         """ Update display and state to reach the specified move number.
 
+        Start from the closest checkpoint before the move if it is closer than the current move, and save the
+        checkpoints met on the way.
+
         move_nr -- the move number to jump to.
         """
         if move_nr is not None:
@@ -43,10 +53,17 @@ class ControllerBase:
             if lastmove is not None:
                 bound = max(0, min(move_nr, lastmove.number))
                 self.rules.reset()  # need to do it manually, because it is not done below
+                start = self._checkpoint_before(bound)
+                if start is not None and bound - start < abs(bound - self.head):
+                    self.rules.restore(self.checkpoints[start])
+                    self.head = start
+                interval = self.checkpoint_interval
                 while self.head < bound:
                     move = self.kifu.getmove_at(self.head + 1)
                     self.rules.put(move, reset=False)
                     self.head += 1
+                    if not self.head % interval and self.head not in self.checkpoints:
+                        self.checkpoints[self.head] = self.rules.snapshot()
                 while bound < self.head:
                     move = self.kifu.getmove_at(self.head)
                     self.rules.remove(move, reset=False)
@@ -55,18 +72,139 @@ class ControllerBase:
                 return True
         return False
 
+    def _checkpoint_before(self, number):
+        """ Return the number of the last checkpoint saved at or before the move number, or None.
+        """
+        interval = self.checkpoint_interval
+        nr = number - number % interval
+        while 0 < nr:
+            if nr in self.checkpoints:
+                return nr
+            nr -= interval
+        return None
+
+    def _rules_before(self, number):
+        """ Return a new RuleUnsafe holding the moves played before the move number, built from the closest state
+        known to the controller (the current state or a checkpoint).
+        """
+        rule = RuleUnsafe(superko=self.rules.superko)  # no need for thread safety here
+        start = self._checkpoint_before(number - 1)
+        if start is None:
+            start = 0
+        if start <= self.head < number:
+            rule.restore(self.rules.snapshot())
+            start = self.head
+        elif start:
+            rule.restore(self.checkpoints[start])
+        for mv in self.kifu.get_move_seq(start + 1, number - 1):
+            rule.put(mv, reset=False)
+        return rule
+
+    def _recorded_hashes(self):
+        """ Return the hashes of the positions of the game known to the controller, from the first move on.
+        """
+        hashes = self.rules.hashes
+        if self.checkpoints:
+            last = self.checkpoints[max(self.checkpoints)].hashes
+            if len(hashes) < len(last):
+                hashes = last
+        return hashes
+
+    def _replay_from(self, rule, number, shift=0):
+        """ Put on rule the recorded moves from the move number to the end of the game, shifted by "shift" places.
+
+        Stop as soon as the position reached is the recorded one for two moves in a row: from there, the game goes on
+        as recorded. This shortcut is not taken when a superko rule is enforced, since it depends on all the
+        positions met before.
+
+        Return None if the moves could be played, else the number of the first move that could not (in the recorded
+        game) and the StateError it raised.
+        """
+        recorded = self._recorded_hashes() if rule.superko is None else ()
+        hashes = rule.hashes
+        for mv in self.kifu.get_move_seq(number):
+            if shift:
+                mv = mv.copy()
+                mv.number += shift
+            try:
+                rule.put(mv, reset=False)
+            except StateError as se:
+                return mv.number - shift, se
+            i = mv.number - shift - 1  # the index of the recorded position
+            if 0 < i < len(recorded) and hashes[-1] == recorded[i] and hashes[-2] == recorded[i - 1]:
+                break
+
+    def _invalidate(self, number):
+        """ Drop the checkpoints that may be affected by an edit of the move number (i.e. the ones saved after it).
+        """
+        for nr in [nr for nr in self.checkpoints if number <= nr]:
+            del self.checkpoints[nr]
+
     def _append(self, move):
         """
         Append the move to self.kifu if the controller is pointing at the last move.
-        Raise an exception otherwise, as branching (creating a variation inside the game) is not supported yet.
+        Start a new variation otherwise: the moves after the current one are kept in the game, but are no longer part
+        of the current line of play (see Kifu.branch()).
 
         """
+        self._invalidate(move.number)
         if self.at_last_move():
             self.kifu.append(move)
-            self.rules.confirm()
-            self._incr_move_number()
         else:
-            raise NotImplementedError("Variations not allowed yet. Hold 'b' or 'w' key + click to insert a move")
+            self.kifu.branch(move)
+        self.rules.confirm()
+        self._incr_move_number()
+
+    def switch_variation(self, number, index):
+        """ Make the current line of play follow another variation from move "number" on, and go to that move.
+
+        Only the moves from the current one back to the branching point are removed from the goban, then the first move
+        of the variation is put.
+
+        number -- the number of the move starting the variation.
+        index -- the index of the variation to follow, see Kifu.variations().
+
+        Nothing changes if the first move of the variation is not legal:
+
+        >>> import os, tempfile
+        >>> fd, path = tempfile.mkstemp(suffix=".sgf")
+        >>> with os.fdopen(fd, "w") as f:
+        ...     _ = f.write("(;GM[1]SZ[19];B[aa];W[bb](;B[cc];W[dd])(;B[aa])(;B[ee]))")
+        >>> controller = ControllerBase()
+        >>> controller.log = controller.err = lambda _: None
+        >>> _ = controller.loadkifu(path)
+        >>> controller.goto(4)
+        True
+        >>> controller.switch_variation(3, 1)
+        Traceback (most recent call last):
+        ...
+        golib.model.exceptions.StateError: Occupied
+        >>> controller.head, [str(move) for move in controller.kifu.get_move_seq()]
+        (4, ['B[A19]', 'W[B18]', 'B[C17]', 'W[D16]'])
+        >>> controller.switch_variation(3, 2)
+        True
+        >>> controller.head, [str(move) for move in controller.kifu.get_move_seq()]
+        (3, ['B[A19]', 'W[B18]', 'B[E15]'])
+        >>> controller.goto(0)
+        True
+        >>> sum(controller.rules[x][y] != E for x in range(gsize) for y in range(gsize))
+        0
+        >>> os.remove(path)
+        """
+        if 0 < number <= self.head:
+            self._invalidate(number)
+            first = self.kifu.variations(number)[0][index].copy()
+            first.number = number
+            # check the variation on the rules before touching self.head and self.kifu, in case it is not legal
+            self.rules.reset()
+            for nr in range(self.head, number - 1, -1):
+                self.rules.remove(self.kifu.getmove_at(nr), reset=False)
+            self.rules.put(first, reset=False)
+            self.kifu.switch(number, index)
+            self.head = number
+            self.rules.confirm()
+            return True
+        return False
 
     def _bulk_update(self, moves):
         """
@@ -80,15 +218,17 @@ class ControllerBase:
         order = {E: 0, B: 1, W: 1}  # keep B/W order, but removals must be performed and confirmed before appending
         moves = sorted(moves, key=lambda m: order[m.color])
         if self.at_last_move():
-            rule_save = self.rules.copy()  # to rollback if something goes wrong
-            kifu_save = self.kifu.copy()   # to rollback if something goes wrong
+            # to rollback if something goes wrong
+            self.rules.begin()
+            self.kifu.begin()
             number_save = self.head
-            self.rules.reset()
+            success = False
             try:
                 i = 0
                 mv = moves[i]
                 while mv.color is E:
                     torem = self.kifu.locate(mv.x, mv.y).getmove()
+                    self._invalidate(torem.number)
                     self.rules.remove(torem, reset=False)
                     self.kifu.delete(torem)
                     self.head -= 1
@@ -102,6 +242,7 @@ class ControllerBase:
                 while i < len(moves):
                     assert mv.color in (B, W)
                     mv.number = self.head + 1
+                    self._invalidate(mv.number)
                     self.rules.put(mv, reset=False)
                     self.kifu.append(mv)
                     self.head += 1
@@ -111,12 +252,18 @@ class ControllerBase:
                     else:
                         break
                 self.rules.confirm()  # save addition changes
+                success = True
                 self.log_mn()
             except StateError as se:
-                self.rules = rule_save
-                self.kifu = kifu_save
-                self.head = number_save
                 print("Bulk update failed: {}".format(se))
+            finally:
+                if success:
+                    self.rules.commit()
+                    self.kifu.commit()
+                else:
+                    self.rules.rollback()
+                    self.kifu.rollback()
+                    self.head = number_save
         else:
             raise NotImplementedError("Variations not allowed yet. Please navigate to end of game.")
 
@@ -128,6 +275,7 @@ class ControllerBase:
         """
         move = self.kifu.locate(x, y, upbound=self.head).getmove()
         self.rules.remove(move)
+        self._invalidate(move.number)
         self.rules.confirm()
         self.kifu.delete(move)
         self._incr_move_number(step=-1)
@@ -193,7 +341,7 @@ class ControllerUnsafe(ControllerBase):
 
     def __init__(self, user_input, display, sgffile=None):
         super().__init__(None)  # use our own kifu loading
-        self.rules = Rule(listener=display)
+        self.rules = Rule(listener=display, superko=golib_conf.superko)
         self.display = display
         self.input = user_input
         self.clickloc = None
@@ -233,6 +381,7 @@ class ControllerUnsafe(ControllerBase):
             self.input.keyin.bind("<Escape>", lambda _: self._select())
             self.input.keyin.bind("<Delete>", self._del_selected)
             self.input.keyin.bind("<BackSpace>", self._del_selected)
+            self.input.keyin.bind("<v>", self._next_variation)
         except AttributeError as ae:
             self.err("Some keys could not be found.")
             self.err(ae)
@@ -295,7 +444,7 @@ class ControllerUnsafe(ControllerBase):
         y_loc = int(self.clickloc[1])
         if (x_loc, y_loc) != (x_, y_):
             self.dragging = True
-            color = self.rules.stones[x_loc][y_loc]
+            color = self.rules[x_loc][y_loc]
             if color in (B, W):
                 origin = self.kifu.locate(x_loc, y_loc).getmove()
                 dest = Move(TK_TYPE, (color, x_, y_), number=origin.number)
@@ -304,6 +453,7 @@ class ControllerUnsafe(ControllerBase):
                         self.rules.remove(origin)
                         self.rules.put(dest, reset=False)
                         self.rules.confirm()
+                        self._invalidate(origin.number)
                         self.kifu.relocate(origin, dest)
                         self.display.highlight(self.kifu.getmove_at(self.head))
                         self.clickloc = x_, y_
@@ -322,6 +472,7 @@ class ControllerUnsafe(ControllerBase):
         move = Move('tk', (color, x, y), number=self.head + 1)
         # check for potential conflict: browsing could be blocked if we occupy a position already used later in game
         if self._checkinsert(move):
+            self._invalidate(move.number)
             self.rules.put(move)
             self.kifu.insert(move, self.head + 1)
             self.rules.confirm()
@@ -355,6 +506,21 @@ class ControllerUnsafe(ControllerBase):
             except StateError as se:
                 self.err(se)
 
+    def _next_variation(self, event=None):
+        """
+        Replace the current move by the next alternative found in the game, if any.
+
+        """
+        if 0 < self.head:
+            moves, index = self.kifu.variations(self.head)
+            if 1 < len(moves):
+                try:
+                    self.switch_variation(self.head, (index + 1) % len(moves))
+                    self.display.highlight(self.kifu.getmove_at(self.head))
+                    self.log_mn()
+                except StateError as se:
+                    self.err(se)
+
     def _del_selected(self, _):
         try:
             if self.selected is not None:
@@ -378,19 +544,15 @@ class ControllerUnsafe(ControllerBase):
         """
         # checking move presence in self.kifu is not enough,
         # as the current stone may be captured before any conflict appears
-        rule = RuleUnsafe()  # no need for thread safety here
-
-        nr = 0
-        # initialize rule object up to insert position (excluded)
-        for nr in range(1, self.head + 1):
-            rule.put(self.kifu.getmove_at(nr), reset=False)
-
-        # perform check
+        rule = self._rules_before(move.number)
         try:
             rule.put(move, reset=False)  # new move insertion
-            for nr in range(self.head + 1, self.kifu.lastmove().number + 1):
-                rule.put(self.kifu.getmove_at(nr), reset=False)
+            # the following moves are only replayed until their positions match the recorded ones
+            conflict = self._replay_from(rule, move.number, shift=1)
         except StateError as se:
+            conflict = self.head, se
+        if conflict is not None:
+            nr, se = conflict
             self.err("Cannot insert %s at %d: %s at move %d" % (move.color, self.head, se, nr))
             return False
         return True
@@ -481,13 +643,14 @@ class ControllerUnsafe(ControllerBase):
         x, y = get_intersection(event)
         node = self.kifu.locate(x, y, upbound=self.head)
         if node is not None:
-            move = node.getmove()
+            move = node.getmove().copy()  # the node's move is shared, don't modify it
             move.color = enemy_of(move.color)
             # now check that the insertion of that stone with the opposite color is not going to break anything
             if self._check_update(move, message="Cannot swap color"):
                 self.rules.remove(node.getmove())
                 self.rules.put(move, reset=False)
                 self.rules.confirm()
+                self._invalidate(move.number)
                 self.kifu.update_mv(move, node)
 
     def _check_update(self, move: Move, message: str="Cannot update move"):
@@ -501,22 +664,20 @@ class ControllerUnsafe(ControllerBase):
         Return True if no problem is anticipated, False if the update should be refused. Note: no real action is taken.
 
         """
-        rule = RuleUnsafe()
-        moves = self.kifu.get_move_seq()
-        try:
-            previous = moves[move.number - 1]  # move indexing is 1-based
-            assert previous.number == move.number
-            # assert (previous.x, previous.y) == (move.x, move.y)
-            moves[move.number - 1] = move
-        except AssertionError:
+        previous = self.kifu.getmove_at(move.number)
+        if previous is None or previous.number != move.number:
             print("Unexpected kifu moves list in Controller.check_color_swap()")
             return False
-        i = 0
+        rule = self._rules_before(move.number)
         try:
-            for i, mv in enumerate(moves):
-                rule.put(mv, reset=False)
+            rule.put(move, reset=False)
+            # the following moves are only replayed until their positions match the recorded ones
+            conflict = self._replay_from(rule, move.number + 1)
         except StateError as se:
-            self.err("{} {}: leads to {} at move {}".format(message, move.number, se, i))
+            conflict = move.number, se
+        if conflict is not None:
+            nr, se = conflict
+            self.err("{} {}: leads to {} at move {}".format(message, move.number, se, nr - 1))
             return False
         return True
 
@@ -1,6 +1,6 @@
 
 from golib.model.move import Move, TK_TYPE, SGF_TYPE, NP_TYPE, KGS_TYPE
-from golib.model.sgf_ck import CollectionGl, GameTreeGl, NodeGl, Parser
+from golib.model.sgf_ck import CollectionGl, GameTreeGl, NodeGl, Parser, iter_games, load_lazy
 from golib.model.exceptions import *
 from golib.model.kifu import Kifu
-from golib.model.rules import Rule, RuleUnsafe, enemy_of
+from golib.model.rules import Rule, RuleUnsafe, BitRuleUnsafe, enemy_of
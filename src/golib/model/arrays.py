@@ -0,0 +1,126 @@
+import array
+
+try:
+    import numpy
+except ImportError:  # optional dependency, the array module is used instead
+    numpy = None
+
+from golib.config.golib_conf import gsize, B, W
+from golib.model import CollectionGl, GameTreeGl, NodeGl
+from golib.model.packing import PASS, mainline
+
+
+"""
+Export of lines of play as integer arrays, for batch analysis that does not go through the SGF objects.
+
+Each move is a record of 4 integers: number, color (index in COLORS), x, y. Both coordinates are PASS for a pass move.
+With NumPy, records are the items of a structured array of dtype MOVE_DTYPE. Otherwise, they are flattened in an
+array.array of typecode 'i': the fields of the i-th move are at [4 * i: 4 * i + 4].
+
+Several games are exported as a flat buffer holding the records of all games one after the other, plus the offsets of
+the first record of each game, and the total number of records: game i is flat[offsets[i]:offsets[i + 1]] (to be
+multiplied by 4 without NumPy).
+
+"""
+
+FIELDS = ("number", "color", "x", "y")
+COLORS = (B, W)
+
+MOVE_DTYPE = None if numpy is None else numpy.dtype([("number", "<i4"), ("color", "i1"), ("x", "i1"), ("y", "i1")])
+
+_codes = {color: code for code, color in enumerate(COLORS)}
+
+
+def records(nodes):
+    """ Yield the (number, color, x, y) record of each node holding a move. Other nodes are skipped.
+    """
+    for node in nodes:
+        properties = node.properties
+        for color in COLORS:
+            try:
+                pos = properties[color][0]
+            except KeyError:
+                continue
+            if len(pos) and pos != "--":  # Kifu writes the passes it records as "--"
+                x, y = ord(pos[0]) - 97, ord(pos[1]) - 97
+            else:
+                x = y = PASS
+            yield properties["MN"][0], _codes[color], x, y
+            break
+
+
+def to_array(nodes, use_numpy=True):
+    """ Return the records of the moves held by nodes, as a NumPy structured array if possible.
+
+    Args:
+        nodes: iterable
+            The nodes of a line of play.
+        use_numpy: bool
+            False to get an array.array even if NumPy is available.
+    """
+    if use_numpy and numpy is not None:
+        return numpy.array(list(records(nodes)), dtype=MOVE_DTYPE)
+    data = array.array('i')
+    for record in records(nodes):
+        data.extend(record)
+    return data
+
+
+def iter_records(data):
+    """ Yield the (number, color, x, y) tuples of the records of data, as returned by to_array().
+    """
+    if isinstance(data, array.array):
+        fields = iter(data)
+        return zip(fields, fields, fields, fields)
+    return iter(data.tolist())
+
+
+def extend(game, data):
+    """ Append to the game tree one node per record of data. The game tree must not have variations.
+    """
+    previous = game.nodes[-1] if game.nodes else None
+    for number, color, x, y in iter_records(data):
+        node = NodeGl(game, previous)
+        node.properties[COLORS[color]] = ["" if x == PASS else chr(x + 97) + chr(y + 97)]
+        node.properties["MN"] = [number]
+        game.nodes.append(node)
+        previous = node
+
+
+def dump_collection(games, use_numpy=True):
+    """ Return the offsets and the flat buffer holding the records of the main line of each game.
+
+    Args:
+        games: iterable
+            The GameTreeGl objects to export, e.g. the children of a CollectionGl, or sgf_ck.iter_games(f).
+        use_numpy: bool
+            False to get array.array objects even if NumPy is available.
+    """
+    arrays = [to_array(mainline(game), use_numpy=use_numpy) for game in games]
+    if use_numpy and numpy is not None:
+        offsets = numpy.zeros(len(arrays) + 1, dtype=numpy.int64)
+        numpy.cumsum([len(data) for data in arrays], out=offsets[1:])
+        flat = numpy.concatenate(arrays) if arrays else numpy.empty(0, dtype=MOVE_DTYPE)
+        return offsets, flat
+    offsets = array.array('q', [0])
+    flat = array.array('i')
+    for data in arrays:
+        flat.extend(data)
+        offsets.append(len(flat) // len(FIELDS))
+    return offsets, flat
+
+
+def load_collection(offsets, flat):
+    """ Return a CollectionGl holding one game per entry of offsets (except the last), as returned by dump_collection().
+    """
+    collection = CollectionGl()
+    width = 1 if MOVE_DTYPE is not None and getattr(flat, "dtype", None) == MOVE_DTYPE else len(FIELDS)
+    for i in range(len(offsets) - 1):
+        game = GameTreeGl(collection)
+        root = NodeGl(game, None)
+        root.properties["SZ"] = [gsize]
+        root.properties["MN"] = [0]
+        game.nodes.append(root)
+        extend(game, flat[width * int(offsets[i]):width * int(offsets[i + 1])])
+        collection.children.append(game)
+    return collection
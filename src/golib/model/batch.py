@@ -0,0 +1,209 @@
+try:
+    import numpy
+except ImportError:  # optional dependency, required by BatchRules
+    numpy = None
+
+from golib.config.golib_conf import gsize
+from golib.model.packing import PASS
+
+
+"""
+Check of the rules on many games at once, for batch analysis of game collections.
+
+The goban of each game is a layer of a (N, gsize, gsize) int8 array, and each step plays one move on every goban. The
+chains of stones are found by flood fills run on all the gobans together, so that the cost of a step is paid once for
+the whole batch instead of once per game.
+
+The moves are read from the records of arrays.dump_collection() (see check_collection()). The first illegal move of
+each game is reported with the messages of the StateError raised by RuleUnsafe: "Ko", "Suicide" or "Occupied". The
+superko rules are not checked.
+
+Each step has a fixed cost of a few NumPy calls, whatever the number of games. On synthetic games of about 250 moves,
+the break-even point with one RuleUnsafe per game is around 100 games: check_collection() is 3x slower on 20 games, and
+2x faster on 300 games (see "glbench.py batch"). Prefer RuleUnsafe for small collections.
+
+Requires NumPy.
+
+"""
+
+# the values of the intersections of the gobans. the value of a stone is 1 - 2 * color, color being an index in
+# arrays.COLORS, so that the enemy of a stone has the opposite value
+EMPTY = 0
+BLACK = 1
+WHITE = -1
+
+# the neighbors of an intersection, same order as rules.touch()
+_directions = ((-1, 0), (1, 0), (0, 1), (0, -1))
+
+
+def _dilate(masks):
+    """ Return the intersections of the boolean masks that are in, or directly connected to, a True intersection.
+
+    The last two dimensions of masks are the rows and columns of the goban.
+    """
+    grown = masks.copy()
+    grown[..., 1:, :] |= masks[..., :-1, :]
+    grown[..., :-1, :] |= masks[..., 1:, :]
+    grown[..., :, 1:] |= masks[..., :, :-1]
+    grown[..., :, :-1] |= masks[..., :, 1:]
+    return grown
+
+
+def _dead_chains(seeds, stones, free):
+    """ Return the chains of stones that contain the seeds and have no liberty.
+
+    The chains are found by dilating the seeds inside stones until stable. A chain stops growing, and is dropped, as
+    soon as it touches a free intersection: the cost depends on the distance to the closest liberty, not on the size
+    of the chain.
+
+    Args:
+        seeds, stones: numpy.ndarray
+            Boolean masks of shape (M, gsize, gsize). Each of the M layers is filled independently.
+        free: numpy.ndarray
+            Boolean mask of the same shape: the empty intersections.
+    """
+    chains = seeds & stones
+    growing = numpy.flatnonzero(chains.any(axis=(1, 2)))
+    while len(growing):
+        current = chains[growing]
+        dilated = _dilate(current)
+        alive = (dilated & free[growing]).any(axis=(1, 2))
+        chains[growing[alive]] = False
+        grown = dilated & stones[growing]
+        changed = ~alive & (grown != current).any(axis=(1, 2))
+        growing = growing[changed]
+        chains[growing] = grown[changed]
+    return chains
+
+
+class BatchRules:
+    """ The gobans of several games, played in parallel.
+
+    Attributes:
+        boards: numpy.ndarray
+            The stones of each game, as an (N, gsize, gsize) int8 array of EMPTY, BLACK or WHITE values.
+        played: numpy.ndarray
+            The number of moves played on each goban so far.
+        errors: list
+            For each game, None, or the number and the message of the first move that could not be played. No move
+            is played on a game after its first error.
+    """
+
+    def __init__(self, n):
+        if numpy is None:
+            raise ImportError("NumPy is required to check games in batch.")
+        self.boards = numpy.zeros((n, gsize, gsize), dtype=numpy.int8)
+        self.played = numpy.zeros(n, dtype=numpy.int64)
+        self.errors = [None] * n
+        self._failed = numpy.zeros(n, dtype=bool)
+        # 2 * flat index + color of the stone captured by the last move of each game when it captured only one, else -1
+        self._ko = numpy.full(n, -1, dtype=numpy.int64)
+
+    def play(self, games, records):
+        """ Play one move on each of the provided gobans, and record the games where the move is illegal.
+
+        Args:
+            games: numpy.ndarray
+                The indexes of the games to play, each at most once.
+            records: numpy.ndarray
+                The move to play in each of these games, as records of dtype arrays.MOVE_DTYPE.
+        """
+        games = numpy.asarray(games, dtype=numpy.int64)
+        valid = ~self._failed[games]
+        games, records = games[valid], records[valid]
+        xs = records["x"].astype(numpy.int64)
+        ys = records["y"].astype(numpy.int64)
+
+        passes = (xs == PASS) | (ys == PASS)
+        self.played[games[passes]] += 1
+        self._ko[games[passes]] = -1
+        games, records, xs, ys = games[~passes], records[~passes], xs[~passes], ys[~passes]
+
+        boards = self.boards[games]
+        occupied = boards[numpy.arange(len(games)), xs, ys] != EMPTY
+        self._fail(games[occupied], records[occupied], "Occupied")
+        keep = ~occupied
+        games, records, xs, ys, boards = games[keep], records[keep], xs[keep], ys[keep], boards[keep]
+        if not len(games):
+            return
+
+        k = numpy.arange(len(games))
+        colors = records["color"].astype(numpy.int64)
+        values = (1 - 2 * colors).astype(numpy.int8)
+        boards[k, xs, ys] = values
+        free = boards == EMPTY
+
+        # the chain of the new stone, then the enemy chains touching it: a chain has to be filled only if its seed has
+        # no liberty of its own. liberties are looked for before the captures: this only matters to the chain of the
+        # new stone, which is only checked when nothing is captured
+        padded = numpy.zeros((len(games), gsize + 2, gsize + 2), dtype=bool)
+        padded[:, 1:-1, 1:-1] = free
+        owners, seeds_x, seeds_y, seeds_value = [], [], [], []
+        for dx, dy in ((0, 0),) + _directions:
+            sx, sy = xs + dx, ys + dy
+            inside = (0 <= sx) & (sx < gsize) & (0 <= sy) & (sy < gsize)
+            sx, sy = sx.clip(0, gsize - 1), sy.clip(0, gsize - 1)
+            value = values if dx == dy == 0 else -values
+            start = inside & (boards[k, sx, sy] == value)
+            for ex, ey in _directions:
+                start &= ~padded[k, sx + 1 + ex, sy + 1 + ey]
+            owners.append(k[start])
+            seeds_x.append(sx[start])
+            seeds_y.append(sy[start])
+            seeds_value.append(value[start])
+        owner = numpy.concatenate(owners)
+        seeds = numpy.zeros((len(owner), gsize, gsize), dtype=bool)
+        seeds[numpy.arange(len(owner)), numpy.concatenate(seeds_x), numpy.concatenate(seeds_y)] = True
+        stones = boards[owner] == numpy.concatenate(seeds_value)[:, None, None]
+        dead = _dead_chains(seeds, stones, free[owner])
+
+        first = len(owners[0])
+        suicide = numpy.zeros(len(games), dtype=bool)
+        suicide[owners[0]] = dead[:first].any(axis=(1, 2))
+        captured = numpy.zeros(boards.shape, dtype=bool)
+        for found in owners[1:]:
+            captured[found] |= dead[first:first + len(found)]  # a game is found at most once per direction
+            first += len(found)
+        boards[captured] = EMPTY
+        counts = captured.sum(axis=(1, 2))
+
+        # check for ko rule, same conditions as RuleUnsafe
+        ko = (counts == 1) & (3 < self.played[games] + 1) & (self._ko[games] == 2 * (xs * gsize + ys) + colors)
+
+        # check for suicide play if not already safe (killed at least one enemy)
+        suicide &= counts == 0
+
+        self._fail(games[ko], records[ko], "Ko")
+        self._fail(games[suicide], records[suicide], "Suicide")
+        legal = ~(ko | suicide)
+        games = games[legal]
+        self.boards[games] = boards[legal]
+        self.played[games] += 1
+        flat = captured[legal].reshape(len(games), gsize * gsize)
+        self._ko[games] = numpy.where(counts[legal] == 1, 2 * flat.argmax(axis=1) + 1 - colors[legal], -1)
+
+    def _fail(self, games, records, message):
+        self._failed[games] = True
+        for g, number in zip(games.tolist(), records["number"].tolist()):
+            self.errors[g] = number, message
+
+
+def check_collection(offsets, flat):
+    """ Play all the games of a collection in parallel, and return the first illegal move of each.
+
+    Args:
+        offsets: numpy.ndarray
+            The index in flat of the first record of each game, followed by the total number of records.
+        flat: numpy.ndarray
+            The moves of all the games, as records of dtype arrays.MOVE_DTYPE. See arrays.dump_collection().
+
+    Return a list holding for each game None if all its moves are legal, else the number and the message of its first
+    illegal move.
+    """
+    offsets = numpy.asarray(offsets, dtype=numpy.int64)
+    starts, lengths = offsets[:-1], numpy.diff(offsets)
+    rules = BatchRules(len(lengths))
+    for step in range(int(lengths.max()) if len(lengths) else 0):
+        games = numpy.flatnonzero(step < lengths)
+        rules.play(games, flat[starts[games] + step])
+    return rules.errors
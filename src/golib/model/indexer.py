@@ -0,0 +1,100 @@
+import collections
+import functools
+import json
+import multiprocessing
+import os
+
+from golib.model import sgf
+from golib.model.sgf_lex import split_games, tokenize, IDENT, VALUE
+
+
+"""
+Extraction of per-game metadata from directories of SGF files, spread across worker processes.
+
+Workers only lex the main line of the first game of each file: no NodeGl is created, and only small records are sent
+back to the parent process.
+
+"""
+
+GameRecord = collections.namedtuple("GameRecord", "path size black white result nb_moves opening")
+
+
+def index_file(path, nb_moves=20):
+    """ Return the GameRecord of the first game found in the file, or None if it can't be read.
+
+    Args:
+        nb_moves: int
+            The number of moves to keep in the "opening" field, as a list of strings like "Bpd".
+    """
+    try:
+        with open(path) as f:
+            text = next(split_games(f), None)
+        if text is None:
+            return None
+        root = {}
+        opening = []
+        count = 0
+        nodes = 0
+        ident = None
+        for kind, value in tokenize(text):
+            if kind == IDENT:
+                ident = value
+                if ident == 'B' or ident == 'W':
+                    count += 1
+            elif kind == VALUE:
+                if nodes == 1 and ident not in root:
+                    root[ident] = value
+                if (ident == 'B' or ident == 'W') and len(opening) < nb_moves:
+                    opening.append(ident + value)
+            elif value == ';':
+                nodes += 1
+            elif value == ')':
+                break  # the first closing parenthesis ends the main line, which always follows the first variation
+    except (OSError, UnicodeDecodeError, sgf.ParseException):
+        return None
+    size = root.get("SZ")
+    return GameRecord(path, int(size) if size and size.isdigit() else None,
+                      root.get("PB"), root.get("PW"), root.get("RE"), count, opening)
+
+
+def find_sgf(directories):
+    """ Yield the path of each SGF file found in the directories, recursively.
+    """
+    for directory in directories:
+        for dirpath, _, filenames in os.walk(directory):
+            for name in filenames:
+                if name.lower().endswith(".sgf"):
+                    yield os.path.join(dirpath, name)
+
+
+def build_index(directories, output, nb_moves=20, processes=None, chunksize=64):
+    """ Index all the SGF files found in the directories, and write one JSON array per game to the output file object.
+
+    Args:
+        processes: int
+            The number of worker processes, defaults to the number of cores.
+        chunksize: int
+            The number of files sent to a worker at once. Bigger chunks mean less inter-process communication.
+
+    Return indexed, failed: int, int
+        The number of files indexed, and the number of files that could not be read.
+    """
+    indexed = failed = 0
+    work = functools.partial(index_file, nb_moves=nb_moves)
+    with multiprocessing.Pool(processes) as pool:
+        for record in pool.imap_unordered(work, find_sgf(directories), chunksize=chunksize):
+            if record is None:
+                failed += 1
+            else:
+                output.write(json.dumps(record, ensure_ascii=False))
+                output.write("\n")
+                indexed += 1
+    return indexed, failed
+
+
+def load_index(index_file_path):
+    """ Yield the GameRecord objects stored in an index file.
+    """
+    with open(index_file_path) as f:
+        for line in f:
+            yield GameRecord(*json.loads(line))
@@ -0,0 +1,127 @@
+import os
+
+
+"""
+Append-only log of the edits made to a Kifu since its file was last written.
+
+Each edit costs one small line appended to the journal, instead of a rewrite of the whole game. After a crash, the
+edits are replayed on top of the last full save (see Kifu.__init__()). Writing the game file again (Kifu.save() or
+Kifu.compact()) folds the journal into it and deletes the journal.
+
+The first line of the journal identifies the version of the game file it applies to (size and modification time),
+so that a journal left behind by an interrupted save is never replayed on top of the newer game file.
+
+"""
+
+# suffix appended to the game file name to get the journal file name
+JOURNAL_EXT = ".journal"
+
+# record types
+APPEND = "A"    # color x y number
+INSERT = "I"    # color x y number position
+DELETE = "D"    # color x y number
+RELOCATE = "R"  # color x y dest_x dest_y
+UPDATE = "U"    # node_index color x y number
+BRANCH = "B"    # color x y number
+SWITCH = "S"    # index of the variation followed at each branching point, from the root
+
+
+class Journal:
+    """ The journal of edits of one game file.
+
+    Attributes:
+        sgffile: str
+            The game file the journal applies to.
+        filepath: str
+            The journal file.
+        size: int
+            The number of records in the journal.
+        limit: int
+            The number of records above which the owner of the journal should compact it. None for no limit.
+        sync: bool
+            True to force each record to disk (os.fsync()), instead of only flushing it to the operating system.
+
+    The edits recorded before a crash are replayed when the game is opened again, the record being written during the
+    crash excepted:
+
+    >>> import shutil, tempfile
+    >>> from golib.model import Kifu, Move, TK_TYPE
+    >>> directory = tempfile.mkdtemp()
+    >>> path = os.path.join(directory, "game.sgf")
+    >>> kifu = Kifu(path, journal=True, log=lambda _: None)
+    >>> kifu.save()  # doctest: +ELLIPSIS
+    Game saved to: ...game.sgf
+    >>> for number, (color, x, y) in enumerate([("B", 3, 3), ("W", 15, 15), ("B", 15, 3)], 1):
+    ...     kifu.append(Move(TK_TYPE, (color, x, y), number=number))
+    >>> kifu.delete(Move(TK_TYPE, ("W", 15, 15), number=2))
+    >>> _ = kifu.journal._file.write("A W 3")  # crash in the middle of a record, the game file is never written
+    >>> kifu.journal._file.flush()
+    >>> del kifu
+    >>> recovered = Kifu(path, journal=True, log=lambda _: None)
+    >>> [str(move) for move in recovered.get_move_seq()], recovered.journal.size
+    (['B[D16]', 'B[Q16]'], 4)
+    >>> recovered.save()  # doctest: +ELLIPSIS
+    Game saved to: ...game.sgf
+    >>> os.listdir(directory)
+    ['game.sgf']
+    >>> shutil.rmtree(directory)
+    """
+
+    def __init__(self, sgffile, limit=1000, sync=False):
+        self.sgffile = sgffile
+        self.filepath = sgffile + JOURNAL_EXT
+        self.size = 0
+        self.limit = limit
+        self.sync = sync
+        self._file = None
+
+    def record(self, kind, *fields):
+        """ Append one record to the journal.
+        """
+        if self._file is None:
+            header = not os.path.exists(self.filepath)
+            self._file = open(self.filepath, 'a')
+            if header:
+                self._file.write(self._header() + "\n")
+        self._file.write(" ".join([kind] + [str(field) for field in fields]) + "\n")
+        self._file.flush()
+        if self.sync:
+            os.fsync(self._file.fileno())
+        self.size += 1
+
+    def records(self):
+        """ Yield the fields of each complete record, as a list of strings. Yield nothing if the journal does not
+        apply to the current version of the game file.
+        """
+        try:
+            with open(self.filepath) as f:
+                lines = f.read().split("\n")
+        except FileNotFoundError:
+            return
+        # the last line is either empty, or an incomplete record that was being written during a crash
+        lines.pop()
+        if lines and lines[0] == self._header():
+            for line in lines[1:]:
+                yield line.split(" ")
+
+    def full(self):
+        return self.limit is not None and self.limit <= self.size
+
+    def discard(self):
+        """ Delete the journal file.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        try:
+            os.remove(self.filepath)
+        except FileNotFoundError:
+            pass
+        self.size = 0
+
+    def _header(self):
+        try:
+            stat = os.stat(self.sgffile)
+            return "G {0} {1}".format(stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            return "G - -"  # the game has not been written yet
@@ -1,86 +1,256 @@
+import os
+import shutil
 import sys
 
 from golib.config.golib_conf import appname, gsize, B, W
-from golib.model import CollectionGl, GameTreeGl, NodeGl, Parser, SgfWarning, SGF_TYPE
+from golib.model import CollectionGl, GameTreeGl, NodeGl, SgfWarning, StateError, SGF_TYPE, iter_games, load_lazy
+from golib.model import Move, TK_TYPE, arrays, packing, journal
+from golib.model.journal import Journal
+from golib.model.spots import SpotIndex
+from golib.model.sgf import ParseException
+
+
+_DROP = "drop"  # undo record of a variation removed because its last node was deleted
+_MERGE = "merge"  # undo record of a variation merged into its parent, after its last sibling was removed
+_SPLIT = "split"  # undo record of a game tree split to start a variation
+
+# the kinds of edit accepted by Kifu.apply_edits(), with their effect on the number of moves
+_EDITS = {journal.INSERT: 1, journal.DELETE: -1, journal.RELOCATE: 0, journal.UPDATE: 0}
 
 
 class Kifu:
     """ Provide common interactions with the SGF structure.
 
-    Only one line of play is supported: no variations are allowed.
-    This means that an entire game is one single list of nodes.
+    Edits apply to the current line of play: the main line by default, or the variation chosen with switch(). Lines
+    of play are stored in the SGF tree, so that variations share the nodes before their branching point. Another
+    variation is started with branch(), or by appending a move at a branching point.
 
     Attributes:
         game: GameTree
             The object backing the recording of this kifu.
         sgffile: str
-            The file where to load/save the game.
+            The file where to load/save the game. Games are stored in the binary format of the packing module
+            instead of SGF if the file has the packing.PACKED_EXT extension. Saving there is refused if the game
+            has data this format can't store (see packing.lost()).
         modified: bool
             Indicates whether this game has been modified since load/save.
+        journal: Journal
+            If not None, where each edit is recorded as soon as it is made.
+
+    Move numbers are assumed to be consecutive on the main line. The nodes holding moves are indexed by move number,
+    and renumbering is deferred: after an insert or a delete, the MN property of subsequent nodes is only updated when
+    they are accessed through this class, or when the game is written. Inserts and deletes are still O(n) in the
+    length of the line, since they insert in or delete from Python lists: see _insert_node().
+
+    The moves played on each intersection are also indexed, so that locate() and contains_pos() don't have to decode
+    the whole game. That index is kept up to date in O(log n) by inserts and deletes, see SpotIndex.
     """
 
-    def __init__(self, sgffile=None, log=None, err=None):
+    def __init__(self, sgffile=None, log=None, err=None, lazy=False, journal=False):
+        """
+        Args:
+            lazy: bool
+                If True, only index the file when opening it, and decode each node when it is first accessed.
+                Faster to open big files, provided that not all nodes are needed.
+            journal: bool
+                If True, record each edit in a journal next to sgffile. If such a journal already exists (e.g. after
+                a crash), the edits it contains are first replayed on top of the game loaded from sgffile.
+        """
         self.game = None
         self.sgffile = None
-        self._parse(sgffile, log=log, err=err)
+        self.journal = None
+        self._moves = None  # the nodes holding a move, the n-th move being at index n - self._base
+        self._base = 1
+        self._stale = None  # the index in self._moves from which MN properties may be outdated
+        self._head = None  # (nodes, i) while self._moves is None: the first nodes holding a move, found before _line[i]
+        self._spots = None  # the SpotIndex of the nodes in self._moves
+        self._undo = None  # the edits made since begin(), with what's needed to revert them
+        self._pending = None  # the journal records of the edits made since begin()
+        self._modified = False  # the value of self.modified when begin() was called
+        self._path = None  # the game trees holding the current line of play, from the root
+        self._line = None  # the nodes of the current line of play, the same list as self.game.nodes if no variations
+        self._retree = False  # True if a node shared with other variations has been inserted or deleted
+        self._parse(sgffile, log=log, err=err, lazy=lazy)
+        self._follow()
         self.modified = False
+        if journal and sgffile is not None:
+            self.sgffile = sgffile  # even if it does not exist yet, that's where the journal will be folded
+            self.journal = Journal(sgffile)
+            self._recover()
 
     def copy(self):
+        self._renumber()
         copy = Kifu(log=lambda _: None)
-        copy.game.nodes.clear()
+        collection = CollectionGl()
+        copy.game = self.game.copy(parent=collection)
+        collection.children.append(copy.game)
+        copy._follow(self._choices())
         copy.sgffile = self.sgffile
         copy.modified = self.modified
-        previous = None
-        for node in self:
-            ng = NodeGl(copy.game, previous)
-            ng.properties = {}
-            for k, v in node.properties.items():
-                if type(v) is list:
-                    ng.properties[k] = list(v)
-                else:
-                    ng.properties[k] = v
-            assert type(node.first) is int
-            ng.first = node.first
-            # no variations allowed yet, but that may have to be copied someday
-            # ng.previous_variation = node.previous_variation
-            # ng.variations = list(node.variations)
-            copy.game.nodes.append(ng)
-            if previous is not None:
-                previous.next = ng
-            previous = ng
         return copy
 
+    def begin(self):
+        """ Start a transaction: the edits made until commit() can be reverted by rollback().
+
+        Edits are recorded in the journal, if any, only when committed.
+        """
+        assert self._undo is None, "Transaction already started."
+        self._undo = []
+        self._pending = []
+        self._modified = self.modified
+
+    def commit(self):
+        """ Keep the edits made since begin().
+        """
+        pending = self._pending
+        self._undo = self._pending = None
+        for kind, fields in pending:
+            self._record(kind, *fields)
+
+    def rollback(self):
+        """ Revert the edits made since begin(), most recent first. The cost is proportional to the number of edits.
+
+        >>> kifu = Kifu(log=lambda _: None)
+        >>> for i in range(5):
+        ...     kifu.append(Move(TK_TYPE, ((B, W)[i % 2], i, 0), number=i + 1))
+        >>> kifu.branch(Move(TK_TYPE, (B, 8, 8), number=3))
+        >>> kifu.begin()
+        >>> kifu.switch(3, 0)
+        >>> kifu.update_mv(Move(TK_TYPE, (W, 2, 0), number=3), kifu.locate(2, 0))
+        >>> kifu.branch(Move(TK_TYPE, (W, 9, 9), number=2))
+        >>> kifu.rollback()
+        >>> [(move.color, move.x, move.y) for move in kifu.get_move_seq()]
+        [('B', 0, 0), ('W', 1, 0), ('B', 8, 8)]
+        >>> kifu.switch(3, 0)
+        >>> [(move.color, move.x, move.y) for move in kifu.get_move_seq()]
+        [('B', 0, 0), ('W', 1, 0), ('B', 2, 0), ('W', 3, 0), ('B', 4, 0)]
+        """
+        undo = self._undo
+        self._undo = self._pending = None
+        if undo:
+            # nodes moved off the current line may have kept the numbers they had on it
+            self._retree = True
+            self._head = None
+        while undo:
+            kind, node, arg = undo.pop()
+            if kind == journal.APPEND:
+                self._delete_at(len(self._index()) - 1)
+            elif kind == journal.INSERT:
+                self._delete_at(arg)
+            elif kind == journal.DELETE:
+                self._insert_node(node, *arg)
+            elif kind == _DROP:
+                parent = node.parent
+                parent.children[arg:arg + len(node.children)] = [node]
+                for child in node.children:
+                    child.parent = node
+                for p, tree in enumerate(self._path):
+                    if tree.parent is node:
+                        self._path.insert(p, node)
+                        break
+                else:
+                    self._path.append(node)
+            elif kind == _MERGE:
+                self._split(node.parent.nodes[arg - 1], tail=node)
+            elif kind == _SPLIT:
+                self._merge(node)
+            elif kind == journal.BRANCH:
+                self._delete_at(len(self._index()) - 1)  # also removes the variation, now empty
+                self._extend(arg)
+            elif kind == journal.SWITCH:
+                self._reroute(*arg)
+            elif kind == journal.RELOCATE:
+                self._move_node(node, arg.color, arg, arg.number)
+            elif kind == journal.UPDATE:
+                self._renumber()
+                self._retree = True
+                previous = node.getmove()
+                node.properties.clear()
+                node.properties.update(arg)
+                node.invalidate()
+                self._respot(node, previous)
+        self.modified = self._modified
+
     def append(self, move):
-        """ Append the move at the end of the game.
+        """ Append the move at the end of the current line of play. If the line ends at a branching point, start a
+        new variation.
         """
+        if self._stale is not None and self._moves:
+            self._fresh(len(self._moves) - 1)  # the new node may be numbered after it
         node = self._prepare(move)
-        self.game.nodes.append(node)
+        self._line_insert(len(self._line), node)
+        if self._moves is not None:
+            self._moves.append(node)
+            if self._spots is not None:
+                self._spots.append(node)
+        else:
+            self._head = None
+        self.modified = True
+        self._save_undo(journal.APPEND, node, None)
+        self._record(journal.APPEND, move.color, move.x, move.y, move.number)
+
+    def branch(self, move):
+        """ Start a new variation with the provided move, as an alternative to the move having the same number in the
+        current line of play. The new variation becomes the current line.
+
+        If the current line has no such move, append instead.
+        """
+        moves = self._index()
+        j = move.number - self._base
+        if len(moves) <= j:
+            self.append(move)
+            return
+        i = self._node_index(self._fresh(j), j)
+        self._split(self._line[i - 1])
+        removed = self._cut(i, j)
+        node = self._prepare(move)
+        self._line_insert(i, node)  # the line now ends at a branching point: creates the variation
+        moves.append(node)
+        if self._spots is not None:
+            self._spots.append(node)
         self.modified = True
+        self._save_undo(journal.BRANCH, node, removed)
+        self._record(journal.BRANCH, move.color, move.x, move.y, move.number)
+
+    def switch(self, number, index):
+        """ Make the current line of play follow another variation, from move "number" on.
+
+        Only the nodes after the branching point are visited.
+
+        Args:
+            number: int
+                The number of the move starting the variation.
+            index: int
+                The index of the variation to follow, see variations().
+        """
+        removed = self._switch(number, index)
+        if removed is not None:
+            self._save_undo(journal.SWITCH, None, (number, removed))
+            self._record(journal.SWITCH, *self._choices())
+
+    def variations(self, number):
+        """ Return the moves that can be played as move "number" after the previous moves of the current line, and
+        the index of the one in the current line.
+        """
+        self._index()
+        node = self._fresh(number - self._base)
+        siblings = self._siblings(node)
+        moves = [node.getmove() if tree is node.parent else tree.nodes[0].getmove() for tree in siblings]
+        return moves, siblings.index(node.parent)
 
     def insert(self, move, position: int):
         """ Insert the move at the provided position. Increment subsequent moves number by one.
         If position points to the end of the game, append instead.
         """
+        moves = self._index()
         new_node = self._prepare(move)
         new_node.number(position)
 
-        idx = None
-        # update subsequent moves number
-        for i in range(len(self)):
-            nod = self.game.nodes[i]
-            try:
-                nb = nod.properties["MN"][0]
-                if position <= nb:
-                    nod.properties["MN"][0] += 1
-                if nb == position:
-                    idx = i
-            except KeyError:
-                pass  # not a move
-
-        if idx is not None:
-            self.game.nodes.insert(idx, new_node)
-        elif i == position - 1:
-            self.game.nodes.append(new_node)
+        j = position - self._base
+        if 0 <= j <= len(moves):
+            self._insert_node(new_node, j)
+            self._save_undo(journal.INSERT, new_node, j)
+            self._record(journal.INSERT, move.color, move.x, move.y, move.number, position)
         self.modified = True
 
     def relocate(self, origin, dest):
@@ -88,35 +258,87 @@ class Kifu:
         The move number is not changed.
         """
         node = self.locate(origin.x, origin.y)
-        a, b = dest.get_coord(SGF_TYPE)
-        node.properties[origin.color] = [a + b]
+        self._save_undo(journal.RELOCATE, node, node.getmove().copy())
+        self._move_node(node, origin.color, dest, node.properties["MN"][0])
         self.modified = True
+        self._record(journal.RELOCATE, origin.color, origin.x, origin.y, dest.x, dest.y)
 
     def delete(self, move):
         """ Delete the provided move if found, and decrement subsequent move numbers by one.
         """
-        decr = False
-        torem = None
-        for node in self:
-            if decr:
-                node.properties["MN"][0] -= 1
-            else:
-                try:
-                    if node.getmove().number == move.number:
-                        decr = True
-                        torem = node
-                        # keep looping to decrement subsequent moves
-                except AttributeError:
-                    pass  # not a move
-        if torem is not None:
-            self.game.nodes.remove(torem)
+        j = move.number - self._base
+        if 0 <= j < len(self._index()):
+            self._remove(j)
             self.modified = True
+            self._record(journal.DELETE, move.color, move.x, move.y, move.number)
+
+    def apply_edits(self, ops):
+        """ Apply a batch of edits to the current line of play. If one of them is invalid, raise StateError before
+        any change is made.
+
+        Moves are found by number instead of being located on the goban, the spatial index is rebuilt at most once
+        for the whole batch, and so is the numbering of the moves.
+
+        Args:
+            ops: list
+                The (kind, move) tuples describing each edit, in order. move.number is the number of the move to
+                edit, after the previous edits have been applied. The kinds of edit are:
+                    journal.INSERT: insert the move.
+                    journal.DELETE: delete the move having that number, the color and coordinates of move are ignored.
+                    journal.RELOCATE: move the stone to the coordinates of move.
+                    journal.UPDATE: change the color of the stone to the color of move.
+        """
+        length = len(self._index())
+        for k, (kind, move) in enumerate(ops):
+            if kind not in _EDITS:
+                raise StateError("Edit {0}: unknown kind '{1}'".format(k, kind))
+            j = move.number - self._base
+            if not 0 <= j < length + (kind == journal.INSERT):
+                raise StateError("Edit {0}: no move {1} to edit".format(k, move.number))
+            if kind != journal.DELETE and move.color not in (B, W):
+                raise StateError("Edit {0}: invalid color '{1}'".format(k, move.color))
+            length += _EDITS[kind]
+        if not ops:
+            return
+        self._spots = None  # rebuild on next access, rather than update it at each edit
+        for kind, move in ops:
+            j = move.number - self._base
+            if kind == journal.INSERT:
+                node = self._prepare(move)
+                self._insert_node(node, j)
+                self._save_undo(journal.INSERT, node, j)
+                self._record(journal.INSERT, move.color, move.x, move.y, move.number, move.number)
+            elif kind == journal.DELETE:
+                node = self._remove(j)
+                mv = node.getmove()
+                self._record(journal.DELETE, mv.color, mv.x, mv.y, move.number)
+            else:
+                node = self._fresh(j)
+                current = node.getmove()
+                if kind == journal.RELOCATE:
+                    edited = Move(TK_TYPE, (current.color, move.x, move.y), number=move.number)
+                else:
+                    edited = Move(TK_TYPE, (move.color, current.x, current.y), number=move.number)
+                saved = {ident: list(values) for ident, values in node.properties.items()}
+                self._save_undo(journal.UPDATE, node, saved)
+                del node.properties[current.color]
+                self._prepare(edited, node=node)
+                if self.journal is not None:
+                    i = self._node_index(node, j)
+                    self._record(journal.UPDATE, i, edited.color, edited.x, edited.y, edited.number)
+        self.modified = True
 
     def update_mv(self, move, node=None):
         """ Update the node with the provided move. If the node is not provided, look for it in the game.
         """
         if node is None:
             node = self.locate(move.x, move.y)
+        self._renumber()
+        if self.journal is not None:
+            self._index()  # built once, so that _respot() finds the node rather than the line being searched
+        if self._undo is not None:
+            self._save_undo(journal.UPDATE, node, {ident: list(values) for ident, values in node.properties.items()})
+        previous = node.getmove()
         for color in (B, W):
             # delete previous move position
             try:
@@ -124,7 +346,11 @@ class Kifu:
             except KeyError:
                 pass
         self._prepare(move, node=node)
+        j = self._respot(node, previous)
         self.modified = True
+        if self.journal is not None:
+            i = self._line.index(node) if j is None else self._node_index(node, j)  # j is None for non-move nodes
+            self._record(journal.UPDATE, i, move.color, move.x, move.y, move.number)
 
     def get_move_seq(self, first=1, last=1000):
         """ Return the sub-sequence of moves. Non-move nodes (like startup node) are skipped.
@@ -135,54 +361,76 @@ class Kifu:
             last: int
                 Node sequence end index, inclusive. NOT interpreted as a move number.
         """
-        seq = []
-        for i in range(first, len(self)):
-            mv = self[i].getmove()
-            if mv and (first <= mv.number <= last):
-                seq.append(mv)
-                if mv.number == last:
-                    break
-        return seq
+        moves = self._moves_upto(last)
+        start = max(first, self._base) - self._base
+        stop = min(last - self._base + 1, len(moves))
+        if moves is not self._moves:
+            return [moves[j].getmove() for j in range(start, stop)]
+        return [self._fresh(j).getmove() for j in range(start, stop)]
+
+    def to_array(self, use_numpy=True):
+        """ Return the moves of the current line of play as integer records, see the arrays module.
+
+        Args:
+            use_numpy: bool
+                False to get an array.array even if NumPy is available.
+        """
+        moves = self._index()
+        self._renumber()
+        return arrays.to_array(moves, use_numpy=use_numpy)
+
+    @classmethod
+    def from_array(cls, data, log=None):
+        """ Return a new game made of the moves of data, as returned by to_array().
+        """
+        kifu = cls(log=log)
+        arrays.extend(kifu.game, data)
+        kifu._follow()
+        return kifu
 
     def getmove_at(self, number: int):
         """ Return the move corresponding to number.
+
+        The nodes after that move are not examined (nor decoded, if the game is lazy) until the whole game has to be
+        indexed, see _moves_upto().
         """
-        for i in range(number, len(self)):
-            mv = self[i].getmove()
-            if mv is not None and mv.number == number:
-                return mv
+        moves = self._moves_upto(number)
+        j = number - self._base
+        if 0 <= j < len(moves):
+            return (moves[j] if moves is not self._moves else self._fresh(j)).getmove()
 
     def locate(self, x: int, y: int, upbound=None):
         """ Return the node describing the provided intersection.
 
-        Search from most recent to least recent, in order to get the stone currently on that location.
+        Look for the most recent move, in order to get the stone currently on that location. Like contains_pos() and
+        lastmove(), the first call indexes the whole game, which decodes all its nodes if it is lazy.
+
+        Args:
+            upbound: int
+                The number of the last move to consider. If not provided, consider the whole game.
         """
-        start = upbound if upbound else len(self) - 1
-        for i in range(start, -1, -1):
-            mv = self[i].getmove()
-            if mv and mv.x == x and mv.y == y:
-                return self[i]
+        j = self._spot_index().last((x, y), upbound - self._base if upbound else None)
+        if j is not None:
+            return self._fresh(j)
 
     def contains_pos(self, x: int, y: int, start: int=0):
-        """ Return the index of the first node containing a move at the provided coordinates.
+        """ Return the number of the first move played at the provided coordinates.
 
         Args:
             start: int
-                The index where to start search (inclusive).
+                The move number where to start search (inclusive).
         """
-        for i in range(start, len(self)):
-            mv = self[i].getmove()
-            if (mv is not None) and (mv.x == x) and (mv.y == y):
-                return i
+        j = self._spot_index().first((x, y), start - self._base)
+        if j is not None:
+            return self._base + j
         return False
 
     def lastmove(self):
         """ Return the last move on the main line of play.
         """
-        for i in range(-1, -len(self), -1):
-            mv = self[i].getmove()
-            if mv is not None:
-                return mv
+        moves = self._index()
+        if moves:
+            return self._fresh(len(moves) - 1).getmove()
 
     def next_color(self):
         """ Return the color of the next move to append, based on a black-white alternation assumption.
@@ -197,43 +445,573 @@ class Kifu:
         """ Save the whole game to file.
         """
         if self.sgffile is not None:
-            with open(self.sgffile, 'w') as f:
-                self.game.output(f)
-                self.modified = False
-                print("Game saved to: " + self.sgffile)
+            self.compact()
+            print("Game saved to: " + self.sgffile)
         else:
             raise SgfWarning("No file defined, can't save.")
 
-    def snapshot(self, filepath):
+    def compact(self):
+        """ Write the whole game to its file, which makes the journal useless: discard it.
+        """
+        self.game.materialize()  # the file may be the source of lazy nodes
+        self._write(self.sgffile)
+        self.modified = False
+        if self.journal is not None:
+            self.journal.discard()
+            if self.journal.sgffile != self.sgffile:
+                self.journal = Journal(self.sgffile, limit=self.journal.limit, sync=self.journal.sync)
+            choices = self._choices()
+            if any(choices) or self._path[-1].children:
+                # the file only tells which variation comes first, and that lines go to the end
+                self._record(journal.SWITCH, *choices)
+
+    def snapshot(self, filepath, compact=False):
         """ Dump the whole game to file system silently, without remembering it (the game is still 'modified')
+
+        Args:
+            compact: bool
+                True to write the SGF on a single line.
+        """
+        self.game.materialize()
+        self._write(filepath, compact=compact)
+
+    def _write(self, filepath, compact=False):
+        """ Write the game to file, as SGF or packed depending on its extension.
+
+        The game is first written to a temporary file next to filepath, which then replaces it. So a crash while
+        writing leaves the previous file, and the journal that applies to it, untouched.
+
+        Raise SgfWarning if the game holds data that the packed format can't store, rather than losing it.
+        """
+        self._renumber()
+        packed = packing.is_packed(filepath)
+        if packed:
+            lost = packing.lost(self.game)
+            if lost is not None:
+                raise SgfWarning("Cannot write {0} to '{1}', please use an SGF file.".format(lost, filepath))
+        tmppath = filepath + ".tmp"
+        try:
+            with open(tmppath, 'wb' if packed else 'w') as f:
+                if packed:
+                    packing.dump(self.game, f)
+                else:
+                    self.game.output(f, compact=compact)
+                f.flush()
+                os.fsync(f.fileno())
+            if os.path.exists(filepath):
+                shutil.copymode(filepath, tmppath)
+            os.replace(tmppath, filepath)
+        except BaseException:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            raise
+
+    def _save_undo(self, kind, node, arg):
+        """ Remember how to revert an edit, if a transaction is ongoing.
+        """
+        if self._undo is not None:
+            self._undo.append((kind, node, arg))
+
+    def _record(self, kind, *fields):
+        """ Append an edit to the journal, if any. Compact the journal if it has grown too big.
         """
-        with open(filepath, 'w') as f:
-            self.game.output(f)
+        if self.journal is not None:
+            if self._pending is not None:
+                self._pending.append((kind, fields))
+                return
+            self.journal.record(kind, *fields)
+            if self.journal.full():
+                self.compact()
+
+    def _recover(self):
+        """ Replay the edits found in the journal, if it applies to the game loaded from sgffile.
+        """
+        jrnl, self.journal = self.journal, None  # don't record the edits being replayed
+        try:
+            for record in jrnl.records():
+                kind, args = record[0], record[1:]
+                if kind == journal.SWITCH:
+                    self._follow([int(index) for index in args])
+                    jrnl.size += 1
+                    continue
+                if kind == journal.UPDATE:
+                    node = self[int(args.pop(0))]
+                color, fields = args[0], [int(field) for field in args[1:]]
+                move = Move(TK_TYPE, (color, fields[0], fields[1]))
+                if kind == journal.RELOCATE:
+                    self.relocate(move, Move(TK_TYPE, (color, fields[2], fields[3])))
+                else:
+                    move.number = fields[2]
+                    if kind == journal.APPEND:
+                        self.append(move)
+                    elif kind == journal.INSERT:
+                        self.insert(move, fields[3])
+                    elif kind == journal.DELETE:
+                        self.delete(move)
+                    elif kind == journal.BRANCH:
+                        self.branch(move)
+                    elif kind == journal.UPDATE:
+                        self.update_mv(move, node)
+                jrnl.size += 1
+        finally:
+            self.journal = jrnl
+        if not jrnl.size:
+            jrnl.discard()  # either missing, empty or outdated
 
     def _prepare(self, move, node=None):
         """ Create or update a node according to the provided move.
         """
         if node is None:
-            node = NodeGl(self.game, self[-1])
+            node = NodeGl(self._path[-1], self._line[-1])
         r, c = move.get_coord(SGF_TYPE)
         node.properties[move.color] = [r + c]  # sgf properties are in a list
+        node.invalidate()
         node.number(nb=move.number)
         return node
 
+    def _index(self):
+        """ Return the list of nodes holding a move, indexed by move number minus self._base. Build it if needed,
+        starting from self._head if the first moves have already been found.
+        """
+        if self._moves is None:
+            self._moves, i = self._head if self._head is not None else ([], 0)
+            self._head = None
+            self._scan(self._moves, i, len(self._line))
+            self._base = max(1, self._moves[0].getmove().number) if self._moves else 1
+            self._stale = None
+            for j, node in enumerate(self._moves):
+                if node.getmove().number != self._base + j:
+                    self._stale = j  # inconsistent numbering, fixed on access
+                    break
+        return self._moves
+
+    def _moves_upto(self, number):
+        """ Return a list of nodes holding a move, indexed like self._moves, that goes at least up to move "number" if
+        the line has such a move.
+
+        While the game has not been fully indexed, only the nodes up to that move are examined, and those found are
+        kept in self._head for the next calls. So navigating the first moves of a lazy game only decodes their nodes.
+        The whole game is indexed if the numbering of the moves is not consistent, since _fresh() has to fix it.
+        """
+        if self._moves is not None:
+            return self._moves
+        moves, i = self._head if self._head is not None else ([], 0)
+        while i < len(self._line) and (not moves or len(moves) <= number - self._base):
+            found = len(moves)
+            i = self._scan(moves, i, found + 1)
+            if found < len(moves):
+                mv = moves[-1].getmove()
+                if not found:
+                    self._base = max(1, mv.number)
+                if mv.number != self._base + found:
+                    self._head = moves, i
+                    return self._index()
+        self._head = moves, i
+        return moves
+
+    def _scan(self, moves, i, count):
+        """ Append to moves the nodes holding a move found in self._line from its index i on, until moves has "count"
+        nodes or the line ends. Return the index of the first node of the line not examined.
+        """
+        line = self._line
+        while i < len(line) and len(moves) < count:
+            node = line[i]
+            i += 1
+            try:
+                if node.getmove() is not None:
+                    moves.append(node)
+            except SgfWarning:
+                pass  # setup node, not a move
+        return i
+
+    def _insert_node(self, node, j, i=None, seg=None, k=None):
+        """ Insert the node holding the move of index j in self._moves, and shift the following moves.
+
+        The following moves are not renumbered (see _outdate()), but the insert in self._moves and in the line of play
+        moves the references that follow, in O(n). That's done by a memory move in C, much cheaper than renumbering
+        the nodes, but linear all the same. Finding the index of the node in the line may also be linear, see
+        _node_index().
+
+        Args:
+            i, seg, k: int, GameTreeGl, int
+                The index of the node in the line of play, and its tree and index in that tree. Computed if not
+                provided.
+        """
+        moves = self._index()
+        if i is None:
+            i = self._node_index(moves[j], j) if j < len(moves) else len(self._line)
+        self._line_insert(i, node, seg, k)
+        moves.insert(j, node)
+        self._outdate(j + 1)
+        if self._spots is not None:
+            self._spots.insert(j, node)
+
+    def _remove(self, j):
+        """ Delete the node holding the move of index j in self._moves, and remember how to revert it.
+        """
+        if self._undo is not None:
+            node = self._fresh(j)
+            i = self._node_index(node, j)
+            seg = node.parent
+            k = i if seg.nodes is self._line else seg.nodes.index(node)
+            self._save_undo(journal.DELETE, node, (j, i, seg, k))
+        return self._delete_at(j)
+
+    def _delete_at(self, j):
+        """ Remove and return the node holding the move of index j in self._moves, and shift the following moves.
+
+        O(n) in the length of the line, like _insert_node().
+        """
+        self._index()
+        node = self._fresh(j)
+        i = self._node_index(node, j)
+        self._moves.pop(j)
+        self._outdate(j)
+        if self._spots is not None:
+            self._spots.remove(node)
+        self._line_delete(i)
+        return node
+
+    def _line_insert(self, i, node, seg=None, k=None):
+        """ Insert the node at index i of the current line of play, and in the game tree holding that part of the line.
+        """
+        line = self._line
+        if seg is None:
+            if i < len(line):
+                seg = line[i].parent
+                k = i if seg.nodes is line else seg.nodes.index(line[i])
+            else:
+                seg = self._path[-1]
+                if seg.children:  # the line ends at a branching point
+                    seg = GameTreeGl(seg)
+                    seg.parent.children.append(seg)
+                    self._path.append(seg)
+                k = len(seg.nodes)
+        node.parent = seg
+        if seg.nodes is not line:
+            seg.nodes.insert(k, node)
+        line.insert(i, node)
+        if not k and seg is not self.game:
+            self._link_variations(seg.parent)
+        if k == len(seg.nodes) - 1 and seg.children:
+            self._link_variations(seg)
+        if seg is not self._path[-1] or seg.children:  # shared with other variations
+            self._retree = True
+
+    def _line_delete(self, i):
+        """ Remove the node at index i of the current line of play, and from the game tree holding it. A variation left
+        without nodes is removed from the game.
+        """
+        line = self._line
+        node = line[i]
+        seg = node.parent
+        if seg is not self._path[-1] or seg.children:  # shared with other variations
+            self._retree = True
+        if seg.nodes is not line:
+            k = seg.nodes.index(node)
+            del seg.nodes[k]
+            if seg is not self.game:
+                if not seg.nodes:
+                    self._drop(seg)
+                elif not k:
+                    self._link_variations(seg.parent)
+        del line[i]
+
+    def _drop(self, seg):
+        """ Remove an empty variation from the game. Its own variations, if any, take its place.
+        """
+        parent = seg.parent
+        index = parent.children.index(seg)
+        parent.children[index:index + 1] = seg.children
+        for child in seg.children:
+            child.parent = parent
+        self._link_variations(parent)
+        self._path.remove(seg)
+        self._save_undo(_DROP, seg, index)
+        if len(parent.children) == 1 and (parent.children[0] in self._path or parent not in self._path):
+            self._merge(parent)  # unless the current line ends at parent
+
+    def _merge(self, tree):
+        """ Move the nodes and variations of the only variation of "tree" to "tree" itself. See _split().
+        """
+        child = tree.children[0]
+        tree.materialize()
+        if tree.nodes is self._line:
+            self._line = list(self._line)
+        k = len(tree.nodes)
+        for node in child.nodes:
+            node.parent = tree
+        tree.nodes.extend(child.nodes)
+        tree.children = child.children
+        for grandchild in tree.children:
+            grandchild.parent = tree
+        if child in self._path:
+            self._path.remove(child)
+        self._save_undo(_MERGE, child, k)
+
+    def _split(self, node, tail=None):
+        """ Move the nodes following "node" in its game tree to a new sub-tree, so that a variation can start after it.
+
+        Args:
+            tail: GameTreeGl
+                The (empty) game tree to use as the new sub-tree, if not a new one.
+        """
+        seg = node.parent
+        seg.materialize()
+        nodes = seg.nodes
+        k = nodes.index(node)
+        if k + 1 < len(nodes):
+            if nodes is self._line:
+                self._line = list(nodes)
+            if tail is None:
+                tail = GameTreeGl(seg)
+            tail.parent = seg
+            tail.nodes = list(nodes[k + 1:])
+            for nod in tail.nodes:
+                nod.parent = tail
+            tail.children = seg.children
+            for child in tail.children:
+                child.parent = tail
+            seg.nodes = list(nodes[:k + 1])
+            seg.children = [tail]
+            self._link_variations(seg)
+            if seg in self._path:
+                self._path.insert(self._path.index(seg) + 1, tail)
+            self._save_undo(_SPLIT, seg, None)
+
+    def _cut(self, i, j):
+        """ Truncate the current line of play before its node of index i, which holds the move of index j in
+        self._moves.
+        Return the game trees that are no longer part of the line.
+        """
+        if self._line is self.game.nodes:
+            self._line = list(self._line)
+        moves = self._moves
+        if self._stale is not None and self._stale < len(moves):
+            self._retree = True  # outdated nodes leave the line, renumber them as variations
+        if self._spots is not None:
+            for node in reversed(moves[j:]):
+                self._spots.remove(node)
+        del moves[j:]
+        del self._line[i:]
+        k = self._path.index(self._line[-1].parent) + 1
+        removed = self._path[k:]
+        del self._path[k:]
+        return removed
+
+    def _extend(self, trees):
+        """ Extend the current line of play with the nodes of the game trees.
+        """
+        moves = self._index()
+        self._outdate(len(moves))  # the variation may have been numbered before an edit of the shared nodes
+        for tree in trees:
+            self._path.append(tree)
+            for node in tree.nodes:
+                self._line.append(node)
+                try:
+                    mv = node.getmove()
+                except SgfWarning:
+                    continue  # setup node, not a move
+                if mv is not None:
+                    moves.append(node)
+                    if self._spots is not None:
+                        self._spots.append(node)
+
+    def _switch(self, number, index):
+        """ See switch(). Return the game trees no longer part of the current line, or None if nothing changed.
+        """
+        self._index()
+        node = self._fresh(number - self._base)
+        siblings = self._siblings(node)
+        if siblings[index] is not node.parent:
+            return self._reroute(number, _descend(siblings[index]))
+
+    def _reroute(self, number, trees):
+        """ Replace the current line of play from move "number" on by the nodes of the game trees.
+        Return the game trees replaced.
+        """
+        self._index()  # may have been dropped by an update, e.g. when rolling back
+        j = number - self._base
+        node = self._fresh(j)
+        removed = self._cut(self._node_index(node, j), j)
+        self._extend(trees)
+        return removed
+
+    def _siblings(self, node):
+        """ Return the game trees of the variations that can replace the one starting with "node", including it.
+        """
+        seg = node.parent
+        if seg is not self.game and seg.nodes[0] is node:
+            return seg.parent.children
+        return [seg]
+
+    def _follow(self, choices=None):
+        """ Set the current line of play from the root of the game.
+
+        Args:
+            choices: list
+                The index of the variation to follow at each branching point. The line stops after the last choice.
+                By default, follow the first variation up to the end of the game.
+        """
+        if self._moves is not None:
+            self._renumber()
+        self._path = [self.game]
+        tree = self.game
+        while tree.children and (choices is None or len(self._path) <= len(choices)):
+            tree = tree.children[choices[len(self._path) - 1] if choices is not None else 0]
+            self._path.append(tree)
+        if len(self._path) == 1:
+            self._line = self.game.nodes
+        else:
+            self._line = [node for tree in self._path for node in tree.nodes]
+        self._moves = self._spots = self._stale = self._head = None
+
+    def _choices(self):
+        """ Return the index of the variation followed by the current line at each branching point.
+        """
+        return [tree.parent.children.index(tree) for tree in self._path[1:]]
+
+    def _link_variations(self, tree):
+        """ Update the links between the last node of "tree" and the first nodes of its variations.
+        """
+        last = tree.nodes[-1]
+        last.variations = [child.nodes[0] for child in tree.children if child.nodes]
+        previous = None
+        for node in last.variations:
+            node.previous = last
+            node.previous_variation = previous
+            node.next_variation = None
+            if previous is not None:
+                previous.next_variation = node
+            previous = node
+
+    def _move_node(self, node, color, dest, number):
+        """ Change the coordinates of the move held by the node to those of "dest".
+
+        Args:
+            number: int
+                The current number of the move, in case the MN property of the node is outdated.
+        """
+        a, b = dest.get_coord(SGF_TYPE)
+        node.properties[color] = [a + b]
+        node.number(number)
+        if self._spots is not None:
+            self._spots.respot(node)
+
+    def _spot_index(self):
+        """ Return the index of the moves played on each intersection, see SpotIndex. Build it if needed.
+
+        The index gives the rank of each move in self._moves, which stays correct across inserts and deletes without
+        rewriting the numbers of the following moves: updating it takes O(log n).
+        """
+        if self._spots is None:
+            self._spots = SpotIndex(self._index(), _spot)
+        return self._spots
+
+    def _respot(self, node, previous):
+        """ Update the indexes after the move held by node has been changed in place, previous being the move it held
+        before (with an up-to-date number). The moves stay where they are, only the spatial index may change.
+
+        Return the index of the node in self._moves, or None if the indexes had to be dropped instead (e.g. the node
+        did not hold a move), to be rebuilt on next access.
+        """
+        moves = self._moves
+        current = node.getmove()
+        j = None if (previous is None or moves is None) else previous.number - self._base
+        if current is None or j is None or not 0 <= j < len(moves) or moves[j] is not node:
+            self._moves = self._spots = self._head = None
+            return None
+        if self._spots is not None:
+            self._spots.respot(node)
+        return j
+
+    def _outdate(self, j):
+        """ Mark the MN property of the moves from index j in self._moves as possibly outdated.
+        """
+        if self._stale is None or j < self._stale:
+            self._stale = j
+
+    def _fresh(self, j):
+        """ Return the node of index j in self._moves, after having updated its move number if needed.
+        """
+        node = self._moves[j]
+        if self._stale is not None and self._stale <= j:
+            number = self._base + j
+            if node.properties["MN"][0] != number:
+                node.number(number)
+        return node
+
+    def _renumber(self):
+        """ Update the MN property of all the nodes from the first possibly outdated one.
+
+        Non-move nodes get the number of the move before them, as done by NodeGl.number().
+        """
+        if self._stale is not None:
+            moves = self._moves
+            j = self._stale
+            self._stale = None
+            if j < len(moves):
+                number = self._base + j - 1
+                nodes = self._line
+                for i in range(self._node_index(moves[j], j), len(nodes)):
+                    node = nodes[i]
+                    if j < len(moves) and node is moves[j]:
+                        number += 1
+                        j += 1
+                    if node.properties.get("MN", [None])[0] != number:
+                        node.number(number)
+        if self._retree:
+            self._retree = False
+            self._renumber_variations()
+
+    def _renumber_variations(self):
+        """ Update the MN property of the nodes of the variations that are not part of the current line of play,
+        according to the number of their previous node.
+        """
+        stack = list(self._path)
+        while stack:
+            tree = stack.pop()
+            number = tree.nodes[-1].properties["MN"][0] if tree.nodes else None
+            for child in tree.children:
+                if child not in self._path:
+                    stack.append(child)
+                    previous = number
+                    for node in child.nodes:
+                        try:
+                            previous += node.getmove() is not None
+                        except SgfWarning:
+                            pass  # setup node, not a move
+                        if node.properties.get("MN", [None])[0] != previous:
+                            node.number(previous)
+
+    def _node_index(self, node, j):
+        """ Return the index in the main line of the node holding the move of index j in self._moves.
+
+        The index is guessed from j in constant time, but falls back to a linear search of the line when non-move
+        nodes (e.g. setup or comment-only nodes) follow the first move.
+        """
+        nodes = self._line
+        guess = j + len(nodes) - len(self._moves)  # exact unless non-move nodes follow the first move
+        if 0 <= guess < len(nodes) and nodes[guess] is node:
+            return guess
+        return nodes.index(node)
+
     def __iter__(self):
         """ Iterate over the nodes of the main line of play.
         """
-        return self.game.nodes.__iter__()
+        self._renumber()
+        return self._line.__iter__()
 
     def __getitem__(self, item):
         """ Return a node of the main line of play.
         """
-        return self.game.nodes.__getitem__(item)
+        self._renumber()
+        return self._line.__getitem__(item)
 
     def __len__(self):
         """ Return the number of nodes on the main line of play.
         """
-        return self.game.nodes.__len__()
+        return self._line.__len__()
 
     def __repr__(self):
         return repr(self.game)
@@ -254,26 +1032,47 @@ class Kifu:
         game.nodes.append(context)
         self.game = game
 
-    def _parse(self, filepath, log=None, err=None):
+    def _parse(self, filepath, log=None, err=None, lazy=False):
         """ Use a GameTree object loaded from the provided file.
         """
         if log is None:
             log = lambda msg: sys.stdout.write(str(msg) + "\n")
         if filepath is not None:
             try:
-                with open(filepath) as f:
-                    parser = Parser()
-                    sgf_string = f.read()
-                    f.close()
-                    collection = CollectionGl(parser)
-                    parser.parse(sgf_string)
-                    log("Opened '{0}'".format(filepath))
+                # only the first game of the collection is used, no need to parse the others
+                if packing.is_packed(filepath):
+                    with open(filepath, 'rb') as f:
+                        self.game = packing.load(f)
+                elif lazy:
+                    collection = load_lazy(filepath)
+                    del collection.children[1:]  # let the file be unmapped as soon as the game is materialized
                     self.game = collection[0]
-                    self.sgffile = filepath
-            except IOError as ioe:
+                else:
+                    with open(filepath) as f:
+                        self.game = next(iter_games(f), None)
+                if self.game is None:
+                    raise ParseException("No game found in '{0}'".format(filepath))
+                log("Opened '{0}'".format(filepath))
+                self.sgffile = filepath
+            except (IOError, ParseException) as e:
                 self._new()
                 if err is not None:
-                    err(ioe)
+                    err(e)
                     err("Opened new game")
         else:
             self._new()
+
+
+def _spot(node):
+    """ Return the intersection of the move held by the node, the key of the SpotIndex of a Kifu.
+    """
+    move = node.getmove()
+    return move.x, move.y
+
+
+def _descend(tree):
+    """ Yield the game tree, and the first variation of each game tree yielded.
+    """
+    while tree is not None:
+        yield tree
+        tree = tree.children[0] if tree.children else None
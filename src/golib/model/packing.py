@@ -0,0 +1,181 @@
+import struct
+
+from golib.config.golib_conf import gsize, B, W
+from golib.model import CollectionGl, GameTreeGl, NodeGl
+from golib.model.sgf import ParseException
+
+
+"""
+Compact binary encoding of a game main line, faster to load than SGF.
+
+Layout (little-endian):
+    header: magic, version, goban size, number of root properties, number of moves
+    root properties: for each, identifier length, identifier, number of values, then each value's length and value
+    moves: one fixed-size record per move: color, x, y, number
+
+Only the properties of the root node and the moves of the main line (following the first variation at each branching
+point) are kept: other properties of move nodes (comments, etc.), non-move nodes and other variations are not stored.
+
+"""
+
+# file extension of packed games
+PACKED_EXT = ".glk"
+
+MAGIC = b"GLKF"
+VERSION = 1
+
+_header = struct.Struct("<4sBBHI")
+_ident = struct.Struct("<BH")
+_value = struct.Struct("<I")
+_move = struct.Struct("<cbbH")
+
+PASS = -128  # coordinates of a pass move
+
+_colors = {B: b'B', W: b'W'}
+_names = {code: color for color, code in _colors.items()}
+
+
+def is_packed(filepath):
+    return filepath is not None and filepath.endswith(PACKED_EXT)
+
+
+def dump(game, f):
+    """ Write the main line of the game tree to the binary file object f.
+    """
+    root = game.nodes[0]
+    chunks = []
+    for ident, values in root.properties.items():
+        ident = ident.encode("ascii")
+        chunks.append(_ident.pack(len(ident), len(values)))
+        chunks.append(ident)
+        for value in values:
+            value = str(value).encode("utf-8")
+            chunks.append(_value.pack(len(value)))
+            chunks.append(value)
+    nb_moves = 0
+    for node in mainline(game):
+        for color in (B, W):
+            try:
+                pos = node.properties[color][0]
+            except KeyError:
+                continue
+            if len(pos) and pos != "--":  # Kifu writes the passes it records as "--"
+                x, y = ord(pos[0]) - 97, ord(pos[1]) - 97
+            else:
+                x = y = PASS
+            chunks.append(_move.pack(_colors[color], x, y, node.properties["MN"][0]))
+            nb_moves += 1
+            break
+    f.write(_header.pack(MAGIC, VERSION, gsize, len(root.properties), nb_moves))
+    f.write(b"".join(chunks))
+
+
+def lost(game):
+    """ Return a description of the data of the game tree that dump() would not write, or None if there is none.
+    """
+    tree = game
+    while len(tree.children) == 1:
+        tree = tree.children[0]
+    if tree.children:
+        return "variations"
+    for node in mainline(game):
+        idents = set(node.properties) - {"MN"}
+        if len(idents & {B, W}) != 1:
+            return "nodes without a move"
+        if idents - {B, W}:
+            return "properties " + ", ".join(sorted(idents - {B, W}))
+    return None
+
+
+def mainline(game):
+    """ Yield the nodes of the main line of the game tree, except the root node.
+    """
+    tree = game
+    nodes = game.nodes[1:]
+    while True:
+        yield from nodes
+        if not tree.children:
+            break
+        tree = tree.children[0]
+        nodes = tree.nodes
+
+
+def load(f):
+    """ Read a game from the binary file object f, and return it as a GameTreeGl.
+
+    Raise ParseException if f does not hold a complete game packed for the goban size of the configuration.
+
+    The moves of the main line are read back unchanged, passes included, and the root properties as strings like in SGF:
+
+    >>> import io
+    >>> from golib.model import Kifu, Move, SGF_TYPE, TK_TYPE
+    >>> kifu = Kifu(log=lambda _: None)
+    >>> kifu.append(Move(TK_TYPE, ("B", 3, 3), number=1))
+    >>> kifu.append(Move(SGF_TYPE, ("W", "-", "-"), number=2))
+    >>> kifu.append(Move(TK_TYPE, ("B", 15, 3), number=3))
+    >>> f = io.BytesIO()
+    >>> dump(kifu.game, f)
+    >>> game = load(io.BytesIO(f.getvalue()))
+    >>> [(str(node.getmove()), node.getmove().number) for node in game.nodes[1:]]
+    [('B[D16]', 1), ('W[pass]', 2), ('B[Q16]', 3)]
+    >>> sorted(game.nodes[0].properties.items())  # doctest: +ELLIPSIS
+    [('C', ['Recorded with Golib.']), ('MN', [0]), ('SZ', ['...'])]
+    >>> load(io.BytesIO(f.getvalue()[:-1]))
+    Traceback (most recent call last):
+    ...
+    golib.model.sgf.ParseException: Truncated packed game
+    """
+    data = f.read()
+    if len(data) < _header.size:
+        raise ParseException("Truncated packed game")
+    magic, version, size, nb_props, nb_moves = _header.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ParseException("Not a packed game (version {0})".format(VERSION))
+    if size != gsize:
+        raise ParseException("Packed game of size {0}, the goban size is {1}".format(size, gsize))
+    collection = CollectionGl()
+    game = GameTreeGl(collection)
+    collection.children.append(game)
+
+    root = NodeGl(game, None)
+    offset = _header.size
+    try:
+        for _ in range(nb_props):
+            length, nb_values = _ident.unpack_from(data, offset)
+            offset += _ident.size
+            ident = _read(data, offset, length).decode("ascii")
+            offset += length
+            values = []
+            for _ in range(nb_values):
+                length, = _value.unpack_from(data, offset)
+                offset += _value.size
+                values.append(_read(data, offset, length).decode("utf-8"))
+                offset += length
+            if ident == "MN":
+                values = [int(values[0])]
+            root.properties[ident] = values
+    except struct.error:
+        raise ParseException("Truncated packed game")
+    except (UnicodeDecodeError, ValueError, IndexError) as e:
+        raise ParseException("Corrupt packed game: {0}".format(e))
+    game.nodes.append(root)
+
+    previous = root
+    for color, x, y, number in _move.iter_unpack(_read(data, offset, nb_moves * _move.size)):
+        if color not in _names or (x != PASS and not (0 <= x < gsize and 0 <= y < gsize)):
+            raise ParseException("Corrupt packed game: invalid move {0} {1} {2}".format(color, x, y))
+        node = NodeGl(game, previous)
+        pos = "" if x == PASS else chr(x + 97) + chr(y + 97)
+        node.properties[_names[color]] = [pos]
+        node.properties["MN"] = [number]
+        game.nodes.append(node)
+        previous = node
+    return game
+
+
+def _read(data, offset, length):
+    """ Return the length bytes of data found at offset. Raise ParseException if data is too short.
+    """
+    if len(data) < offset + length:
+        raise ParseException("Truncated packed game")
+    return data[offset:offset + length]
@@ -1,9 +1,171 @@
+import collections
+import random
 import threading
 
+try:
+    import numpy
+except ImportError:  # optional dependency, only needed by legal_moves(use_numpy=True)
+    numpy = None
+
 from golib.model import Move, StateError, TK_TYPE, SGF_TYPE
 from golib.config.golib_conf import gsize, B, W, E
 
 
+# the goban is stored row after row in a flat list, surrounded by a border of sentinel cells, so that the neighbors of
+# any intersection can be found by adding offsets to its index, without bounds checks
+_width = gsize + 2
+BORDER = "#"  # the color of the sentinel cells
+_offsets = (-_width, _width, 1, -1)  # same order as touch()
+_rows = [(x + 1) * _width + 1 for x in range(gsize)]  # the index of the first intersection of each row
+_points = [start + y for start in _rows for y in range(gsize)]  # the index of each intersection, row after row
+_on_board = sum(1 << p for p in _points)  # the set of all intersections, as a bitset (see BitRuleUnsafe)
+_empty = [E if 0 < i < _width - 1 and 0 < j < _width - 1 else BORDER for i in range(_width) for j in range(_width)]
+
+
+def point(x, y):
+    """ Return the index of the intersection (x, y) in a flat board.
+    """
+    return (x + 1) * _width + y + 1
+
+
+# Zobrist keys: the hash of a position is the XOR of the keys of its stones, the empty board being 0. The seed is fixed
+# so that hashes can be stored and compared across runs.
+_keys = random.Random(19)
+_zobrist = {color: [_keys.getrandbits(64) for _ in _empty] for color in (B, W)}
+_white_to_play = _keys.getrandbits(64)  # XORed to the hash of a position to tell the situation where white is to play
+
+# superko rules: a move may not recreate a previous position (POSITIONAL), or a previous position with the same player
+# to play (SITUATIONAL)
+POSITIONAL = "positional"
+SITUATIONAL = "situational"
+
+# kinds of undo records that are not the assignment of an item: (list, kind, argument)
+_APPENDED = "appended"  # argument unused
+_POPPED = "popped"  # argument: the item popped from the end of the list
+_INSERTED = "inserted"  # argument: the index of the item inserted
+_REMOVED = "removed"  # argument: the index and the item removed
+
+
+# an immutable copy of the state of a RuleUnsafe, see RuleUnsafe.snapshot()
+Snapshot = collections.namedtuple("Snapshot", "board structures deleted history hashes seen")
+
+
+def _undo(log):
+    """ Revert the changes described by the undo records, most recent first, and empty the log.
+
+    An undo record is either (container, key, previous value) with an integer key, or (list, kind, argument), see
+    _APPENDED and others.
+    """
+    while log:
+        target, key, value = log.pop()
+        if key.__class__ is int:
+            target[key] = value
+        elif key is _APPENDED:
+            target.pop()
+        elif key is _POPPED:
+            target.append(value)
+        elif key is _INSERTED:
+            del target[value]
+        else:
+            target.insert(*value)
+
+
+class BoardView:
+    """ Read-only view of a flat board as a gsize x gsize matrix: view[x][y] is the color of the intersection (x, y).
+
+    The rows are views as well, nothing is copied. Slices give lists, like the rows of a list of lists would.
+
+    >>> board = list(_empty)
+    >>> board[point(3, 4)] = B
+    >>> view = BoardView(board)
+    >>> len(view) == len(view[3]) == gsize, view[3][4], view[3][4 - gsize], view[4][3]
+    (True, 'B', 'B', 'E')
+    >>> [row[4] for row in view[2:5]], view[3][3:6], list(view[3])[4]
+    (['E', 'B', 'E'], ['E', 'B', 'E'], 'B')
+    >>> view[3][gsize]  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    IndexError: Row index out of range: ...
+    """
+
+    def __init__(self, board):
+        self.board = board
+
+    def __getitem__(self, x):
+        if x.__class__ is slice:
+            return [_RowView(self.board, start) for start in _rows[x]]
+        return _RowView(self.board, _rows[x])
+
+    def __len__(self):
+        return gsize
+
+
+class _RowView:
+    """ Read-only view of a row of a flat board, see BoardView.
+    """
+
+    __slots__ = ("board", "start")
+
+    def __init__(self, board, start):
+        self.board = board
+        self.start = start
+
+    def __getitem__(self, y):
+        if y.__class__ is slice:
+            return self.board[self.start:self.start + gsize][y]
+        if not -gsize <= y < gsize:
+            raise IndexError("Row index out of range: {0}".format(y))
+        return self.board[self.start + y % gsize]
+
+    def __len__(self):
+        return gsize
+
+    def __iter__(self):
+        return iter(self.board[self.start:self.start + gsize])
+
+
+class Chains:
+    """ The chains of connected stones of a flat board. Each chain is identified by one of its stones, its head.
+
+    Attributes:
+        head: list
+            For each stone of the board, the head of its chain.
+        next: list
+            For each stone, the next stone of its chain: the stones of a chain form a circular linked list.
+        size: list
+            For each head, the number of stones of its chain.
+        libs: list
+            For each head, the number of pseudo-liberties of its chain: the number of (stone, adjacent empty
+            intersection) pairs. A liberty adjacent to several stones of the chain is counted several times, but a chain
+            has no pseudo-liberty exactly when it has no liberty, which is all the rules need to know.
+
+    Values found at the index of an empty intersection are meaningless.
+    """
+
+    def __init__(self, chains=None):
+        if chains is None:
+            self.head = [0] * len(_empty)
+            self.next = [0] * len(_empty)
+            self.size = [0] * len(_empty)
+            self.libs = [0] * len(_empty)
+        else:
+            self.head = list(chains.head)
+            self.next = list(chains.next)
+            self.size = list(chains.size)
+            self.libs = list(chains.libs)
+
+    def stones(self, h):
+        """ Return the stones of the chain of head h.
+        """
+        nxt = self.next
+        stones = [h]
+        s = nxt[h]
+        while s != h:
+            stones.append(s)
+            s = nxt[s]
+        return stones
+
+
 class RuleUnsafe:
     """ Hold the current and historical states of a game. Accept/reject new moves.
 
@@ -11,71 +173,294 @@ class RuleUnsafe:
     Compute the captured stones.
     Hold the history of moves, as well as the history of killed stones, to allow rewind/forward.
 
-    The current implementation of this class is based on "buffers" that are reset before each new change (either put
-    or remove stone). The main line of play is updated only when confirm(). A kind of in-house transaction mechanism.
+    Changes (either put or remove stone) are applied in place, and each modification of the state is written to an
+    undo log. The changes made since the last confirm() are reverted by reset(), which is done before each new change
+    by default. A kind of in-house transaction mechanism, whose cost is proportional to the size of the changes.
+
+    The chains of stones and their liberties are updated along with the stones, so that captures and suicides are
+    detected without exploring the groups around each move.
 
     This class is not thread safe. Plus, its consistency is highly dependent on the good usage of self.confirm()
 
     Attributes:
         listener:
-            Is informed when stones have changed.
-        stones: list(list)
-            The stones that have been confirmed so far.
+            Is informed when stones have changed, with a copy of the confirmed stones (see copystones()).
+        board: list
+            The stones, as a flat list with a border of sentinel cells (see point()). Includes the changes that have
+            not been confirmed yet.
+        stones: BoardView
+            The stones that have been confirmed so far, as a read-only matrix.
+        chains: Chains
+            The chains formed by the stones of board, kept up to date as stones are put, captured or removed.
         deleted: list
             The history of the stones that have been killed so far. Used to put them back on rewind.
         history: list
             The sequence of moves that brought to the current state. Needed by in-sequence modification
             algorithm, to check conflicts with subsequent moves.
-        stones_buff, deleted_buff, history_buff:
-            Copies of above data structures, where incoming changes are first applied. Those changes may be persisted
-            to the official structures using confirm().
+        hashes: list
+            The Zobrist hash of the position reached after each move of history. Can be used as a key to cache data
+            about positions.
+        superko: str
+            None to only forbid the basic ko, else POSITIONAL or SITUATIONAL: forbid moves that recreate a position
+            of the history (pass moves excepted).
     """
 
-    def __init__(self, listener=None):
+    def __init__(self, listener=None, superko=None):
+        assert superko in (None, POSITIONAL, SITUATIONAL), "Unknown superko rule."
         self.listener = listener
-        self.stones = [[E for _ in range(gsize)] for _ in range(gsize)]
-        self.stones_buff = None
-
+        self.superko = superko
+        self.board = list(_empty)
+        self._init_structures()
         self.deleted = []
-        self.deleted_buff = None
-
         self.history = []
-        self.history_buff = None
+        self.hashes = []
+        self._seen = {0: 1}  # the number of occurrences of each situation of the history, see _situation()
+        self._log = []  # the undo records of the changes made since the last confirm() or reset()
+        self._tx_log = None  # the undo records of the changes confirmed since begin()
 
-        self.reset()  # initialize buffers
+    @property
+    def stones(self):
+        return BoardView(self._confirmed_board())
+
+    @property
+    def stones_buff(self):
+        return BoardView(self.board)
 
     def copystones(self):
-        return [list(self[row]) for row in range(gsize)]
+        board = self._confirmed_board()
+        return [board[start:start + gsize] for start in _rows]
 
     def confirm(self):
         """ Persist the state of the last modification (either put() or remove()).
         """
-        if self.stones_buff is not None:
-            self.stones = self.stones_buff
-            self.deleted = self.deleted_buff
-            self.history = self.history_buff
-            if self.listener is not None:
-                self.listener.stones_changed(self.stones)
-        else:
-            self.raisese("Confirmation Denied")
+        if self._tx_log is not None:
+            self._tx_log.extend(self._log)
+        self._log = []
+        if self.listener is not None:
+            self.listener.stones_changed(self.copystones())
+
+    def begin(self):
+        """ Start a transaction: the current confirmed state can be restored by rollback(), until commit().
+
+        Reset the changes that have not been confirmed. From then on, the undo records of each confirmed change are
+        kept.
+        """
+        self.reset()
+        self._tx_log = []
+
+    def commit(self):
+        """ Keep the changes confirmed since begin().
+        """
+        self._tx_log = None
+
+    def rollback(self):
+        """ Restore the confirmed state saved by begin(), and reset the changes that have not been confirmed.
+
+        >>> rule = RuleUnsafe()
+        >>> for number, (color, x, y) in enumerate([(B, 0, 1), (W, 0, 0), (B, 1, 0)], 1):
+        ...     rule.put(Move(TK_TYPE, (color, x, y), number=number))
+        ...     rule.confirm()
+        >>> rule[0][0], len(rule.deleted[-1])  # the white stone has been captured
+        ('E', 1)
+        >>> before = rule.snapshot()
+        >>> rule.begin()
+        >>> rule.put(Move(TK_TYPE, (W, 5, 5), number=4))
+        >>> rule.confirm()
+        >>> rule.remove(Move(TK_TYPE, (B, 1, 0), number=3))  # pending: brings the white stone back
+        >>> rule.stones_buff[0][0], rule[0][0], rule.stones[0][0], rule.copystones()[1][0]
+        ('W', 'E', 'E', 'B')
+        >>> rule.rollback()
+        >>> rule.snapshot()[:-1] == before[:-1], rule.stones_buff[5][5]  # the situations seen may keep counts of 0
+        (True, 'E')
+        """
+        self.reset()
+        _undo(self._tx_log)
+        self._tx_log = None
+        if self.listener is not None:
+            self.listener.stones_changed(self.copystones())
 
     def clear(self):
-        self.__init__(listener=self.listener)
+        self.__init__(listener=self.listener, superko=self.superko)
 
     def copy(self):
-        copy = RuleUnsafe(listener=self.listener)
-        copy.stones = self.copystones()
-        copy.deleted = list(self.deleted)
-        copy.history = list(self.history)
-        copy.reset()
+        copy = type(self)(listener=self.listener, superko=self.superko)
+        copy.board, structures, copy.deleted, copy.history, copy.hashes, copy._seen = self._confirmed(copy=True)
+        copy._set_structures(structures)
         return copy
 
+    def snapshot(self):
+        """ Return an immutable copy of the current state, including the changes not confirmed yet, see restore().
+        """
+        return Snapshot(tuple(self.board), tuple(tuple(lst) for lst in self._structures()), tuple(self.deleted),
+                        tuple(self.history), tuple(self.hashes), tuple(self._seen.items()))
+
+    def restore(self, snapshot):
+        """ Replace the current state by a state returned by snapshot(). The restored state is confirmed.
+
+        The cost is that of copying the snapshot, whatever the number of moves that separate both states. Not allowed
+        during a transaction, since the changes made by restore() are not written to the undo log.
+        """
+        assert self._tx_log is None, "Cannot restore a snapshot during a transaction."
+        board, structures, deleted, history, hashes, seen = snapshot
+        self.board = list(board)
+        self._set_structures([list(lst) for lst in structures])
+        self.deleted = list(deleted)
+        self.history = list(history)
+        self.hashes = list(hashes)
+        self._seen = dict(seen)
+        self._log = []
+
+    def legal_moves(self, color, use_numpy=False):
+        """ Return the intersections where "color" may play in the confirmed state, as put() would decide.
+
+        The whole goban is examined in one pass over the chains, without trying any move.
+
+        Args:
+            color: str
+                B or W.
+            use_numpy: bool
+                True to get a (gsize, gsize) NumPy array of booleans, indexed by [x][y]. Otherwise return an int
+                where bit x * gsize + y is set when (x, y) is legal.
+
+        >>> def brute_force(rule, color):
+        ...     mask = 0
+        ...     number = len(rule.history) + 1
+        ...     for i in range(gsize * gsize):
+        ...         try:
+        ...             rule.put(Move(TK_TYPE, (color, i // gsize, i % gsize), number=number))
+        ...             mask |= 1 << i
+        ...         except StateError:
+        ...             pass
+        ...     rule.reset()
+        ...     return mask
+        >>> rule = RuleUnsafe()
+        >>> moves = [(0, 1), (0, 2), (1, 0), (1, 3), (2, 1), (2, 2), (9, 9), (1, 1), (1, 2)]  # black takes a ko
+        >>> for number, (x, y) in enumerate(moves, 1):
+        ...     rule.put(Move(TK_TYPE, ((B, W)[number % 2 == 0], x, y), number=number))
+        ...     rule.confirm()
+        >>> white = rule.legal_moves(W)
+        >>> white == brute_force(rule, W), rule.legal_moves(B) == brute_force(rule, B)
+        (True, True)
+        >>> white >> (1 * gsize + 1) & 1, white >> 0 & 1, white >> (9 * gsize + 10) & 1  # ko, suicide, free
+        (0, 0, 1)
+        """
+        board, (head, nxt, size, libs), deleted, _, hashes, seen = self._confirmed()
+        enem_color = enemy_of(color)
+        ko = None  # the only stone that could be retaken now, see _append()
+        if 2 < len(deleted) and len(deleted[-1]) == 1:
+            stone = deleted[-1][0]
+            if stone.color == color:
+                ko = point(stone.x, stone.y)
+        h = hashes[-1] if hashes else 0
+        mask = 0
+        for i, p in enumerate(_points):
+            if board[p] != E:
+                continue
+            neighbors = [p + offset for offset in _offsets]
+            # the number of pseudo-liberties that each adjacent chain would lose by the move
+            touched = {}
+            for q in neighbors:
+                if board[q] == B or board[q] == W:
+                    touched[head[q]] = touched.get(head[q], 0) + 1
+            captured = [g for g, n in touched.items() if board[g] == enem_color and libs[g] == n]
+            if captured:
+                if p == ko and len(captured) == 1 and size[captured[0]] == 1:
+                    continue
+            elif E not in [board[q] for q in neighbors] and \
+                    not any(board[g] == color and n < libs[g] for g, n in touched.items()):
+                continue  # suicide
+            if self.superko is not None:
+                key = h ^ _zobrist[color][p]
+                for g in captured:
+                    s = g
+                    while True:
+                        key ^= _zobrist[enem_color][s]
+                        s = nxt[s]
+                        if s == g:
+                            break
+                if seen.get(self._situation(key, color)):
+                    continue
+            mask |= 1 << i
+        return self._mask(mask, use_numpy)
+
+    @staticmethod
+    def _mask(mask, use_numpy):
+        """ Return the bitset of intersections mask, converted to an array of booleans if use_numpy is True.
+        """
+        if use_numpy:
+            if numpy is None:
+                raise ImportError("NumPy is required to get legal moves as an array.")
+            bits = numpy.frombuffer(mask.to_bytes(len(_points) // 8 + 1, "little"), dtype=numpy.uint8)
+            return numpy.unpackbits(bits, bitorder="little")[:len(_points)].astype(bool).reshape(gsize, gsize)
+        return mask
+
+    def position_hash(self):
+        """ Return the Zobrist hash of the current position, including the changes not confirmed yet.
+        """
+        return self.hashes[-1] if self.hashes else 0
+
     def reset(self):
         """ Rollback to the last confirmed state.
         """
-        self.stones_buff = self.copystones()
-        self.deleted_buff = list(self.deleted)
-        self.history_buff = list(self.history)
+        _undo(self._log)
+
+    def _confirmed(self, copy=False):
+        """ Return the confirmed state: board, structures (see _structures()), deleted, history, hashes, situations
+        seen.
+
+        The state itself is returned if there are no pending changes and no copy is requested. Otherwise, the pending
+        changes are reverted on copies, which costs as much as copying the whole state. The reads of the stones only
+        should use _confirmed_board() instead.
+        """
+        structures = self._structures()
+        state = [self.board] + structures + [self.deleted, self.history, self.hashes, self._seen]
+        if copy or self._log:
+            copies = {id(target): target.copy() for target in state}
+            _undo([(copies[id(target)], key, value) for target, key, value in self._log])
+            state = [copies[id(target)] for target in state]
+        return (state[0], state[1:1 + len(structures)]) + tuple(state[1 + len(structures):])
+
+    def _confirmed_board(self):
+        """ Return the confirmed board: the board itself if there are no pending changes, else a copy of it where the
+        intersections changed since the last confirm() are given back their confirmed color.
+        """
+        if not self._log:
+            return self.board
+        board = list(self.board)
+        for p, color in self._confirmed_colors().items():
+            board[p] = color
+        return board
+
+    def _confirmed_colors(self):
+        """ Return the confirmed color of each intersection changed since the last confirm(), by index.
+
+        The oldest undo record of an intersection holds its confirmed color.
+        """
+        board = self.board
+        colors = {}
+        for target, key, value in self._log:
+            if target is board and key not in colors:
+                colors[key] = value
+        return colors
+
+    def _init_structures(self):
+        """ Create the structures that describe the stones of an empty board, besides the board itself: the chains.
+        """
+        self.chains = Chains()
+
+    def _structures(self):
+        """ Return the lists that describe the stones of the board, besides the board itself: the lists of the
+        chains. Must be overridden along with _init_structures() and the methods that update them (e.g. _place(),
+        _lift(), _kill()).
+        """
+        chains = self.chains
+        return [chains.head, chains.next, chains.size, chains.libs]
+
+    def _set_structures(self, structures):
+        """ Replace the lists returned by _structures().
+        """
+        chains = self.chains = Chains()
+        chains.head, chains.next, chains.size, chains.libs = structures
 
     def put(self, move, reset=True):
         """ Try to put the provided move on the Goban, and raise exception if Go rules do not allow it.
@@ -90,21 +475,28 @@ class RuleUnsafe:
             move: Move
                 The move to put. Its number must already have been set, and its color must be in (B, W).
             reset: bool
-                Whether to reset the buffers before applying this move.
+                Whether to reset the pending changes before applying this move.
 
         """
         assert 0 < move.number, "Cannot put a null or negative move number."
         if reset:
             self.reset()
 
-        if move.number == len(self.history_buff):
+        history = self.history
+        log = self._log
+        if move.number == len(history):
             self._append(move)
-            self.history_buff.append(move.copy())
+            history.append(move.copy())
+            log.append((history, _APPENDED, None))
         else:
             self._rewind_to(move)
-            self.history_buff.insert(move.number-1, move.copy())
-            for i in range(move.number, len(self.history_buff)):
-                self.history_buff[i].number += 1
+            history.insert(move.number-1, move.copy())
+            log.append((history, _INSERTED, move.number-1))
+            for i in range(move.number, len(history)):
+                # the moves are referenced by the undo log: update copies
+                log.append((history, i, history[i]))
+                history[i] = mv = history[i].copy()
+                mv.number += 1
             self._forward_from(move)
 
     def remove(self, move, reset=True):
@@ -125,129 +517,274 @@ class RuleUnsafe:
         if reset:
             self.reset()
 
-        if move.number == len(self.history_buff):
+        history = self.history
+        log = self._log
+        if move.number == len(history):
             self._pop(move)
-            self.history_buff.pop()
+            log.append((history, _POPPED, history.pop()))
         else:
             self._rewind_to(move)
-            self.history_buff.pop(move.number-1)
-            for i in range(move.number-1, len(self.history_buff)):
-                self.history_buff[i].number -= 1
+            log.append((history, _REMOVED, (move.number-1, history.pop(move.number-1))))
+            for i in range(move.number-1, len(history)):
+                # the moves are referenced by the undo log: update copies
+                log.append((history, i, history[i]))
+                history[i] = mv = history[i].copy()
+                mv.number -= 1
             self._forward_from(move)
 
     def _forward_from(self, start_move):
-        """ Apply moves from the history buffer, starting at the provided move and up to the last.
+        """ Apply moves from the history, starting at the provided move and up to the last.
         """
-        for i in range(start_move.number - 1, len(self.history_buff)):
-            self._append(self.history_buff[i])
+        for i in range(start_move.number - 1, len(self.history)):
+            self._append(self.history[i])
 
     def _rewind_to(self, move):
         """ Revert the Goban to the provided move number.
         """
         i = -1
-        while move.number <= len(self.deleted_buff):
-            self._pop(self.history_buff[i])
+        while move.number <= len(self.deleted):
+            self._pop(self.history[i])
             i -= 1
 
     def _append(self, move):
-        """ Check if the provided move can be played on the Goban, and update buffers accordingly.
+        """ Check if the provided move can be played on the Goban, and update the state accordingly.
 
-        Raise exception if: Ko, Suicide play, Playing on an already occupied position.
+        Raise exception if: Ko, Superko, Suicide play, Playing on an already occupied position.
         """
+        log = self._log
+        h = self.hashes[-1] if self.hashes else 0
         if move.get_coord(SGF_TYPE) != ('-', '-'):
             assert move.color in (B, W), "Cannot append empty move."
-            if self.stones_buff[move.x][move.y] == E:
+            board = self.board
+            p = point(move.x, move.y)
+            if board[p] == E:
                 enem_color = enemy_of(move.color)
-                self.stones_buff[move.x][move.y] = move.color
+                self._place(p, move.color)
+                h ^= _zobrist[move.color][p]
                 # check if kill (attack advantage)
                 deleted = []
-                self.deleted_buff.append(deleted)
-                safe = False
-                for row, col in touch(move.x, move.y):
-                    neighcolor = self.stones_buff[row][col]
-                    if neighcolor == enem_color:
-                        group, nblibs = self._data(row, col)
-                        if nblibs == 0:
-                            for k, l in group:
-                                deleted.append(Move(TK_TYPE, (enem_color, k, l)))
-                                self.stones_buff[k][l] = E
-                            safe = True  # killed at least one enemy
+                self.deleted.append(deleted)
+                log.append((self.deleted, _APPENDED, None))
+                keys = _zobrist[enem_color]
+                for s in self._kill(p, enem_color):
+                    h ^= keys[s]
+                    k, l = divmod(s, _width)
+                    deleted.append(Move(TK_TYPE, (enem_color, k - 1, l - 1)))
 
                 # check for ko rule
-                if 3 < len(self.deleted_buff):
-                    if len(self.deleted_buff[-1]) == 1:
-                        prevdel = self.deleted_buff[-2]
+                if 3 < len(self.deleted):
+                    if len(self.deleted[-1]) == 1:
+                        prevdel = self.deleted[-2]
                         if (len(prevdel) == 1) and (move == prevdel[0]):
                             self.raisese("Ko")
 
-                # check for suicide play if not already safe
-                if not safe:
-                    _, nblibs = self._data(move.x, move.y)
-                    if not nblibs:
-                        self.raisese("Suicide")
+                # check for suicide play if not already safe (killed at least one enemy)
+                if not deleted and self._dead(p):
+                    self.raisese("Suicide")
+
+                if self.superko is not None and self._seen.get(self._situation(h, move.color)):
+                    self.raisese("Superko")
             else:
                 self.raisese("Occupied")
         else:
             # no check needed if move is "pass"
-            self.deleted_buff.append([])
+            self.deleted.append([])
+            log.append((self.deleted, _APPENDED, None))
+        self.hashes.append(h)
+        log.append((self.hashes, _APPENDED, None))
+        key = self._situation(h, move.color)
+        log.append((self._seen, key, self._seen.get(key, 0)))
+        self._seen[key] = self._seen.get(key, 0) + 1
 
     def _pop(self, move):
-        """ Check if the provided move can be removed from the Goban, and update buffers accordingly.
+        """ Check if the provided move can be removed from the Goban, and update the state accordingly.
 
         Raise exception if the move to pop does not match what's been saved in this rules object.
         """
         if move.get_coord(SGF_TYPE) != ('-', '-'):
-            if self.stones_buff[move.x][move.y] == move.color:
-                self.stones_buff[move.x][move.y] = E
-                captured = self.deleted_buff.pop()
+            board = self.board
+            p = point(move.x, move.y)
+            if board[p] == move.color:
+                self._lift(p)
+                captured = self.deleted.pop()
+                self._log.append((self.deleted, _POPPED, captured))
                 for mv in captured:
-                    self.stones_buff[mv.x][mv.y] = mv.color
+                    self._place(point(mv.x, mv.y), mv.color)
             else:
-                self.raisese("Empty" if self.stones_buff[move.x][move.y] == E else "Wrong Color.")
+                self.raisese("Empty" if board[p] == E else "Wrong Color.")
         else:
-            self.deleted_buff.pop()
+            self._log.append((self.deleted, _POPPED, self.deleted.pop()))
+        h = self.hashes.pop()
+        self._log.append((self.hashes, _POPPED, h))
+        key = self._situation(h, move.color)
+        self._log.append((self._seen, key, self._seen[key]))
+        self._seen[key] -= 1
 
-    def _data(self, x, y, _group=None, _libs=None):
-        """ Compute the list of stones and the number of liberties of the group at (x, y).
+    def _situation(self, h, color):
+        """ Return the key of the situation reached when "color" has played, given the hash h of the position.
+        """
+        if self.superko == SITUATIONAL and color == B:
+            return h ^ _white_to_play
+        return h
 
-        Args:
-            x, y: int, int:
-                The coordinates of one stone of the group.
-            _group, _libs:
-                Internal variables used in the recursion, no need to set them from outside.
-
-        Return group, nb_libs: list, int
-            The stones and the number of liberties of the group.
-        """
-        color = self.stones_buff[x][y]
-        if _group is None:
-            assert color != E
-            _group = []
-            _libs = []
-        if (x, y) not in _group:
-            _group.append((x, y))
-            for x, y in touch(x, y):
-                neighcolor = self.stones_buff[x][y]
-                if neighcolor == E:
-                    if (x, y) not in _libs:
-                        _libs.append((x, y))
-                elif neighcolor == color:
-                    self._data(x, y, _group, _libs)
-        return _group, len(_libs)
+    def _place(self, p, color):
+        """ Put a stone at index p of the board, and merge it with the adjacent chains of the same color.
+
+        Captures are left to the caller.
+        """
+        board = self.board
+        chains = self.chains
+        head, nxt, size, libs = chains.head, chains.next, chains.size, chains.libs
+        log = self._log
+        log.append((board, p, board[p]))
+        log.append((head, p, head[p]))
+        log.append((nxt, p, nxt[p]))
+        log.append((size, p, size[p]))
+        log.append((libs, p, libs[p]))
+        board[p] = color
+        head[p] = nxt[p] = p
+        size[p] = 1
+        free = 0
+        for offset in _offsets:
+            q = p + offset
+            neighcolor = board[q]
+            if neighcolor == E:
+                free += 1
+            elif neighcolor != BORDER:
+                h = head[q]
+                log.append((libs, h, libs[h]))
+                libs[h] -= 1  # the stone at q has lost one pseudo-liberty
+        libs[p] = free
+        for offset in _offsets:
+            q = p + offset
+            if board[q] == color and head[q] != head[p]:
+                # merge the smaller chain into the bigger one
+                big, small = head[q], head[p]
+                if size[big] < size[small]:
+                    big, small = small, big
+                s = small
+                while True:
+                    log.append((head, s, small))
+                    head[s] = big
+                    s = nxt[s]
+                    if s == small:
+                        break
+                log.append((nxt, big, nxt[big]))
+                log.append((nxt, small, nxt[small]))
+                log.append((size, big, size[big]))
+                log.append((libs, big, libs[big]))
+                nxt[big], nxt[small] = nxt[small], nxt[big]  # join both circular lists
+                size[big] += size[small]
+                libs[big] += libs[small]
+
+    def _kill(self, p, color):
+        """ Remove the chains of "color" adjacent to index p that have no liberty, and return their stones.
+        """
+        board = self.board
+        head, libs = self.chains.head, self.chains.libs
+        killed = []
+        for offset in _offsets:
+            q = p + offset
+            if board[q] == color and not libs[head[q]]:
+                killed.extend(self._capture(head[q]))
+        return killed
+
+    def _dead(self, p):
+        """ Return True if the chain of the stone at index p has no liberty.
+        """
+        return not self.chains.libs[self.chains.head[p]]
+
+    def _lift(self, p):
+        """ Remove the stone at index p of the board, and update its chain.
+        """
+        board = self.board
+        chains = self.chains
+        head, nxt, size, libs = chains.head, chains.next, chains.size, chains.libs
+        log = self._log
+        color = board[p]
+        friends = 0
+        free = 0
+        for offset in _offsets:
+            neighcolor = board[p + offset]
+            friends += neighcolor == color
+            free += neighcolor == E
+        if 1 < friends:
+            # the chain may be split by the removal of the stone: rebuild it from its other stones
+            for s in self._capture(head[p]):
+                if s != p:
+                    self._place(s, color)
+            return
+        log.append((board, p, color))
+        board[p] = E
+        if friends:
+            # the stone is at one end of its chain: unlink it
+            h = head[p]
+            previous = p
+            while nxt[previous] != p:
+                previous = nxt[previous]
+            log.append((nxt, previous, p))
+            nxt[previous] = nxt[p]
+            if h == p:
+                h = nxt[p]
+                s = h
+                while True:
+                    log.append((head, s, p))
+                    head[s] = h
+                    s = nxt[s]
+                    if s == h:
+                        break
+                log.append((libs, h, libs[h]))
+                log.append((size, h, size[h]))
+                libs[h] = libs[p]
+                size[h] = size[p]
+            log.append((libs, h, libs[h]))
+            log.append((size, h, size[h]))
+            size[h] -= 1
+            libs[h] -= free
+        for offset in _offsets:
+            q = p + offset
+            neighcolor = board[q]
+            if neighcolor == B or neighcolor == W:
+                h = head[q]
+                log.append((libs, h, libs[h]))
+                libs[h] += 1
+
+    def _capture(self, h):
+        """ Remove the chain of head h from the board, and return its stones.
+        """
+        board = self.board
+        head, libs = self.chains.head, self.chains.libs
+        log = self._log
+        stones = self.chains.stones(h)
+        color = board[h]
+        for s in stones:
+            log.append((board, s, color))
+            board[s] = E
+        for s in stones:
+            for offset in _offsets:
+                q = s + offset
+                neighcolor = board[q]
+                if neighcolor == B or neighcolor == W:
+                    g = head[q]
+                    log.append((libs, g, libs[g]))
+                    libs[g] += 1
+        return stones
 
     def grids_repr(self):
-        """ Display both confirmed and buffered grids side by side. Looks nicer with monospaced fonts.
+        """ Display both confirmed and pending grids side by side. Looks nicer with monospaced fonts.
         """
         string = "Confirmed".ljust(44)
         string += "Buffer\n"
+        confirmed = self.stones
+        pending = self.stones_buff
         for x in range(gsize):
             for y in range(gsize):
-                char = self[y][x]
+                char = confirmed[y][x]
                 string += char if char != E else '~'
                 string += ' '
             string += "  ||  "
             for y in range(gsize):
-                char = self.stones_buff[y][x]
+                char = pending[y][x]
                 string += char if char != E else '~'
                 string += ' '
             string += "\n"
@@ -258,19 +795,200 @@ class RuleUnsafe:
         raise StateError(message)
 
     def __getitem__(self, item):
-        return self.stones.__getitem__(item)
+        """ Return the row of index item of the confirmed stones as a list, or a list of rows if item is a slice.
+        """
+        if item.__class__ is slice:
+            board = self._confirmed_board()
+            return [board[start:start + gsize] for start in _rows[item]]
+        start = _rows[item]
+        row = self.board[start:start + gsize]
+        if self._log:
+            for p, color in self._confirmed_colors().items():
+                if start <= p < start + gsize:
+                    row[p - start] = color
+        return row
 
     def __repr__(self):
         """ For debugging purposes, can be modified at will. """
         return self.grids_repr()
 
 
+def _grow(stones):
+    """ Return the bitset of the intersections of stones, and of the intersections directly connected to them.
+    """
+    return (stones | stones << 1 | stones >> 1 | stones << _width | stones >> _width) & _on_board
+
+
+def _indexes(stones):
+    """ Yield the index of each intersection of the bitset.
+    """
+    while stones:
+        low = stones & -stones
+        yield low.bit_length() - 1
+        stones ^= low
+
+
+class BitRuleUnsafe(RuleUnsafe):
+    """ Same as RuleUnsafe, with the stones of each color also kept as an int used as a bitset (bit p for index p of
+    the board), instead of chains.
+
+    The chain of a stone and its liberties are computed when needed, by growing bitsets with shifts and masks. This
+    makes each check more expensive than with the chains, but no bookkeeping is needed when stones are put or removed.
+
+    The list board is kept along with the bitsets: it is what the reads of the stones (stones, copystones(), self[x])
+    and the undo log rely on, and it tells the color of an intersection in one lookup where the bitsets need two.
+
+    Both engines take the same decisions:
+
+    >>> def play(rule, moves):
+    ...     errors = []
+    ...     for color, x, y in moves:
+    ...         try:
+    ...             rule.put(Move(TK_TYPE, (color, x, y), number=len(rule.history) + 1))
+    ...             rule.confirm()
+    ...         except StateError as error:
+    ...             errors.append(str(error))
+    ...     return errors, rule.copystones(), rule.deleted
+    >>> moves = [(B, 0, 1), (W, 0, 2), (B, 1, 0), (W, 1, 3), (B, 2, 1), (W, 2, 2), (B, 9, 9), (W, 1, 1),
+    ...          (B, 1, 2),  # takes the ko
+    ...          (W, 1, 1), (W, 0, 0), (W, 0, 1),  # ko, suicide, occupied
+    ...          (W, 5, 5), (B, 5, 6), (W, 1, 1)]  # takes the ko back after a threat
+    >>> errors, stones, deleted = play(BitRuleUnsafe(), moves)
+    >>> errors, stones[1][1], stones[1][2], [len(captured) for captured in deleted]
+    (['Ko', 'Suicide', 'Occupied'], 'W', 'E', [0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 1])
+    >>> play(RuleUnsafe(), moves) == (errors, stones, deleted)
+    True
+
+    Attributes:
+        sets: list
+            The bitsets of the black and white stones of board, in this order.
+    """
+
+    def legal_moves(self, color, use_numpy=False):
+        """ See RuleUnsafe.legal_moves().
+        """
+        board, (sets,), deleted, _, hashes, seen = self._confirmed()
+        own, enemies = (sets[0], sets[1]) if color == B else (sets[1], sets[0])
+        enem_color = enemy_of(color)
+        empty = _on_board & ~(own | enemies)
+        ko = None  # the only stone that could be retaken now, see _append()
+        if 2 < len(deleted) and len(deleted[-1]) == 1:
+            stone = deleted[-1][0]
+            if stone.color == color:
+                ko = point(stone.x, stone.y)
+        h = hashes[-1] if hashes else 0
+        # the chains of the board, and their liberties
+        chain_of = {}
+        liberties = {}
+        for stones in (own, enemies):
+            for p in _indexes(stones):
+                if p not in chain_of:
+                    chain = self._chain(p, stones)
+                    liberties[chain] = _grow(chain) & empty
+                    for s in _indexes(chain):
+                        chain_of[s] = chain
+        mask = 0
+        for i, p in enumerate(_points):
+            bit = 1 << p
+            if not empty & bit:
+                continue
+            captured = set()
+            safe = _grow(bit) & empty & ~bit  # the liberties the stone would have
+            for offset in _offsets:
+                q = p + offset
+                if board[q] == enem_color:
+                    if liberties[chain_of[q]] == bit:
+                        captured.add(chain_of[q])
+                elif board[q] == color:
+                    safe |= liberties[chain_of[q]] & ~bit
+            if captured:
+                if p == ko and len(captured) == 1 and bin(next(iter(captured))).count("1") == 1:
+                    continue
+            elif not safe:
+                continue  # suicide
+            if self.superko is not None:
+                key = h ^ _zobrist[color][p]
+                for chain in captured:
+                    for s in _indexes(chain):
+                        key ^= _zobrist[enem_color][s]
+                if seen.get(self._situation(key, color)):
+                    continue
+            mask |= 1 << i
+        return self._mask(mask, use_numpy)
+
+    def _init_structures(self):
+        self.sets = [0, 0]
+
+    def _structures(self):
+        return [self.sets]
+
+    def _set_structures(self, structures):
+        self.sets, = structures
+
+    def _chain(self, p, stones):
+        """ Return the bitset of the chain of the stone at index p, stones being the bitset of the stones of its color.
+        """
+        chain = 1 << p
+        frontier = chain
+        while frontier:
+            frontier = _grow(frontier) & stones & ~chain
+            chain |= frontier
+        return chain
+
+    def _place(self, p, color):
+        i = 0 if color == B else 1
+        self._log.append((self.board, p, self.board[p]))
+        self._log.append((self.sets, i, self.sets[i]))
+        self.board[p] = color
+        self.sets[i] |= 1 << p
+
+    def _lift(self, p):
+        i = 0 if self.board[p] == B else 1
+        self._log.append((self.board, p, self.board[p]))
+        self._log.append((self.sets, i, self.sets[i]))
+        self.board[p] = E
+        self.sets[i] &= ~(1 << p)
+
+    def _kill(self, p, color):
+        board = self.board
+        sets = self.sets
+        i = 0 if color == B else 1
+        empty = _on_board & ~(sets[0] | sets[1])
+        killed = 0
+        for offset in _offsets:
+            q = p + offset
+            if board[q] == color and not killed >> q & 1 and E not in [board[q + o] for o in _offsets]:
+                chain = self._chain(q, sets[i])
+                if not _grow(chain) & empty:
+                    killed |= chain
+        if not killed:
+            return []
+        log = self._log
+        log.append((sets, i, sets[i]))
+        sets[i] &= ~killed
+        stones = list(_indexes(killed))
+        for s in stones:
+            log.append((board, s, color))
+            board[s] = E
+        return stones
+
+    def _dead(self, p):
+        board = self.board
+        if E in [board[p + o] for o in _offsets]:
+            return False
+        sets = self.sets
+        chain = self._chain(p, sets[0] if self.board[p] == B else sets[1])
+        return not _grow(chain) & _on_board & ~(sets[0] | sets[1])
+
+
 class Rule(RuleUnsafe):
     """ Place put(), remove() and confirm() under the same re-entrant lock,to force their sequential execution.
+
+    The reads of the confirmed stones take the lock as well, so that they never see a change halfway through.
     """
 
-    def __init__(self, listener=None):
-        super().__init__(listener=listener)
+    def __init__(self, listener=None, superko=None):
+        super().__init__(listener=listener, superko=superko)
         self.rlock = threading.RLock()
 
     def put(self, move, reset=True):
@@ -281,6 +999,30 @@ class Rule(RuleUnsafe):
         with self.rlock:
             return super().remove(move, reset)
 
+    def begin(self):
+        with self.rlock:
+            return super().begin()
+
+    def commit(self):
+        with self.rlock:
+            return super().commit()
+
+    def snapshot(self):
+        with self.rlock:
+            return super().snapshot()
+
+    def legal_moves(self, color, use_numpy=False):
+        with self.rlock:
+            return super().legal_moves(color, use_numpy)
+
+    def restore(self, snapshot):
+        with self.rlock:
+            return super().restore(snapshot)
+
+    def rollback(self):
+        with self.rlock:
+            return super().rollback()
+
     def confirm(self):
         """ See RuleUnsafe.confirm().
 
@@ -291,6 +1033,15 @@ class Rule(RuleUnsafe):
         with self.rlock:
             return super().confirm()
 
+    @property
+    def stones(self):
+        """ See RuleUnsafe.stones. The view is taken on a copy of the board, so that later changes don't show: each
+        access copies the board. To read a few intersections, prefer self[x][y].
+        """
+        with self.rlock:
+            board = self._confirmed_board()
+            return BoardView(list(board) if board is self.board else board)
+
     def copystones(self):
         if hasattr(self, "rlock"):
             with self.rlock:
@@ -298,6 +1049,10 @@ class Rule(RuleUnsafe):
         else:
             return super().copystones()
 
+    def __getitem__(self, item):
+        with self.rlock:
+            return super().__getitem__(item)
+
 
 def touch(x, y):
     """ Yield the (up to) 4 positions directly connected to (x, y).
@@ -1,4 +1,8 @@
+import io
+import locale
+
 from golib.model import sgf, SGF_TYPE
+from golib.model.sgf_lex import LexParser, MappedSource, split_games, tokenize, tokens, IDENT, VALUE
 
 # little hack to force Tauber's sgf extensibility.
 sgf.createtree = lambda parent, parser=None: GameTreeGl(parent, parser=parser)
@@ -14,7 +18,121 @@ Extensions of Tauber's SGF, in order not to mix codes. This mostly consists in a
 
 """
 
-Parser = sgf.Parser  # redirect, so that go.sgf imports are exclusively made from the current file.
+Parser = LexParser  # redirect, so that go.sgf imports are exclusively made from the current file.
+
+_UNDECODED = object()  # marks a node whose move has not been decoded yet
+
+
+def iter_games(f):
+    """ Yield the top-level GameTreeGl objects of the SGF collection read from the file object f, one at a time.
+
+    Each game is parsed as soon as its closing parenthesis has been read, and is not referenced afterwards by this
+    generator: memory usage depends on the size of the biggest game, not on the size of the collection.
+    """
+    for text in split_games(f):
+        yield build_collection(text)[0]
+
+
+def build_collection(sgf_string):
+    """ Return the CollectionGl described by sgf_string.
+
+    Equivalent to parsing with a Parser bound to a CollectionGl, but the objects are built directly from the tokens,
+    instead of through callbacks that each new tree or node installs on the parser.
+    """
+    collection = CollectionGl()
+    parent = collection
+    tree = None
+    node = None
+    values = None
+    # same states as LexParser.parse()
+    state = 4
+    for kind, text in tokenize(sgf_string):
+        if kind == VALUE:
+            if state != 3 and state != 7:
+                raise sgf.ParseException("[" + text + "]", state)
+            values.append(text)
+            state = 7
+        elif kind == IDENT:
+            if state != 2 and state != 7:
+                raise sgf.ParseException(text, state)
+            values = node.properties[text] = []
+            state = 3
+        else:
+            if state == 2 or state == 7:
+                _end_node(node)
+            elif state == 3 or (state == 1) != (text == ";"):  # ';' must follow '(', and only ';' can follow '('
+                raise sgf.ParseException(text, state)
+            if text == ";":
+                node = _start_node(tree)
+                state = 2
+            elif text == "(":
+                tree = GameTreeGl(parent)
+                parent.children.append(tree)
+                parent = tree
+                state = 1
+            else:
+                if tree is None:
+                    raise sgf.ParseException(text, state)
+                tree = parent = tree.parent
+                if tree is collection:
+                    tree = None
+                state = 4
+    if state != 4 or tree is not None:
+        raise sgf.ParseException("Unexpected end of input", state)
+    return collection
+
+
+def _start_node(tree):
+    """ Create a new node at the end of the tree, and link it with its previous node and sibling variations.
+    See sgf.GameTree.my_start_node().
+    """
+    if tree.nodes:
+        node = NodeGl(tree, tree.nodes[-1])
+    elif isinstance(tree.parent, GameTreeGl):
+        previous = tree.parent.nodes[-1]
+        node = NodeGl(tree, previous)
+        if previous.variations:
+            previous.variations[-1].next_variation = node
+            node.previous_variation = previous.variations[-1]
+        previous.variations.append(node)
+    else:
+        node = NodeGl(tree, None)
+        siblings = tree.parent.children
+        if 1 < len(siblings):
+            node.previous_variation = siblings[-2].nodes[0]
+            siblings[-2].nodes[0].next_variation = node
+    tree.nodes.append(node)
+    return node
+
+
+def _end_node(node):
+    """ See NodeGl.my_end_property() and NodeGl.my_end_node().
+    """
+    number = node.properties.get("MN")
+    if number is not None:
+        node.properties["MN"] = [int(number[0])]
+    node.number()
+
+
+def load_lazy(filepath, encoding=None):
+    """ Return a CollectionGl of LazyGameTreeGl, backed by the memory-mapped file.
+
+    Opening only costs a scan of the delimiters of the file, nodes are decoded when first accessed. The first node of
+    each game is decoded right away, to link it with the first nodes of its sibling games, as done by _start_node().
+    """
+    source = MappedSource(filepath, encoding=encoding)
+    collection = CollectionGl()
+    previous = None
+    for index in source.index():
+        tree = LazyGameTreeGl(collection, source, index)
+        collection.children.append(tree)
+        if tree.nodes:
+            node = tree.nodes[0]
+            if previous is not None:
+                node.previous_variation = previous
+                previous.next_variation = node
+            previous = node
+    return collection
 
 
 class CollectionGl(sgf.Collection):
@@ -41,11 +159,241 @@ class GameTreeGl(sgf.GameTree):
     def __len__(self):
         return self.children.__len__()
 
+    def output(self, f, compact=False):
+        """ Write this game tree to f, in SGF. See SgfWriter.
+        """
+        writer = SgfWriter(f, compact=compact)
+        writer.write(self)
+        writer.flush()
+
+    def copy(self, parent=None):
+        """ Return a deep copy of this game tree, its nodes and its variations.
+
+        The tree is visited with an explicit stack, so that its depth is not limited by recursion.
+
+        Args:
+            parent:
+                The parent of the copy. It is up to the caller to add the copy to its parent's children if needed.
+        """
+        copies = {}  # id of original node -> copied node
+        pairs = []
+        root = None
+        stack = [(self, parent)]
+        while stack:
+            tree, parent_copy = stack.pop()
+            tree_copy = GameTreeGl(parent_copy)
+            if root is None:
+                root = tree_copy
+            else:
+                parent_copy.children.append(tree_copy)
+            for node in tree.nodes:
+                node_copy = NodeGl(tree_copy, None)
+                for k, v in node.properties.items():
+                    node_copy.properties[k] = list(v) if type(v) is list else v
+                node_copy.first = node.first
+                tree_copy.nodes.append(node_copy)
+                copies[id(node)] = node_copy
+                pairs.append((node, node_copy))
+            stack.extend((child, tree_copy) for child in reversed(tree.children))
+        # links may point to nodes of other trees, so they can only be set once all nodes are copied
+        for node, node_copy in pairs:
+            node_copy.previous = copies.get(id(node.previous))
+            node_copy.next = copies.get(id(node.next))
+            node_copy.previous_variation = copies.get(id(node.previous_variation))
+            node_copy.next_variation = copies.get(id(node.next_variation))
+            node_copy.variations = [copies[id(v)] for v in node.variations if id(v) in copies]
+        return root
+
+    def materialize(self):
+        """ Ensure that all nodes have been decoded. Nothing to do here, everything is decoded at parse time.
+        """
+        pass
+
     def __repr__(self):
         return "{0} [{1} nodes] [{2} children]".format(self.__class__.__name__, len(self.nodes), len(self.children))
 
 
+class SgfWriter:
+    """ Serialize game trees to a file object in large chunks, instead of one write per SGF element.
+
+    In default mode, the output is identical to the one of Tauber's GameTree.output() using NodeGl.output(). In compact
+    mode, no newline is written between properties.
+    """
+
+    def __init__(self, f, compact=False, encoding=None, chunk_size=1 << 16):
+        """
+        Args:
+            f: file object
+                The sink, either text or binary. Binary sinks receive text encoded with "encoding".
+            compact: bool
+                True to write everything on one line.
+            encoding: str
+                Defaults to the same encoding as open() in text mode.
+            chunk_size: int
+                The approximate number of characters to buffer before writing to f.
+        """
+        self.f = f
+        self.encoding = None
+        if not isinstance(f, io.TextIOBase):
+            self.encoding = encoding if encoding is not None else locale.getpreferredencoding(False)
+        self.separator = "" if compact else "\n"
+        self.chunk_size = chunk_size
+        self._parts = []
+        self._size = 0
+
+    def write(self, tree):
+        """ Buffer the SGF text of the game tree, and write to f each time enough text has been buffered.
+
+        Variations are visited with an explicit stack, so that the depth of the tree is not limited by recursion.
+        """
+        parts = self._parts
+        stack = [tree]
+        while stack:
+            tree = stack.pop()
+            if tree is None:
+                parts.append(")")
+                continue
+            parts.append("(")
+            for node in tree.nodes:
+                text = self.node_text(node)
+                parts.append(text)
+                self._size += len(text)
+                if self.chunk_size <= self._size:
+                    self.flush()
+            stack.append(None)  # close this tree after all its children
+            stack.extend(reversed(tree.children))
+
+    def node_text(self, node):
+        separator = self.separator
+        text = [";"]
+        for prop, values in node.properties.items():
+            text.append(prop)
+            for value in values:
+                if type(value) is int:
+                    text.append("[%d]" % value)
+                else:
+                    # str.replace() is much faster than str.translate() with multi-character replacements
+                    if "\\" in value:
+                        value = value.replace("\\", "\\\\")
+                    if "]" in value:
+                        value = value.replace("]", "\\]")
+                    text.append("[" + value + "]")
+            text.append(separator)
+        return "".join(text)
+
+    def flush(self):
+        """ Write the buffered text to f.
+        """
+        if self._parts:
+            text = "".join(self._parts)
+            self._parts.clear()
+            self._size = 0
+            self.f.write(text if self.encoding is None else text.encode(self.encoding))
+
+
+class LazyGameTreeGl(GameTreeGl):
+    """ A game tree whose nodes and variations are decoded from a MappedSource on first access.
+
+    The source file must not be modified while a lazy tree is still using it, see materialize().
+    """
+
+    def __init__(self, parent, source, index):
+        super().__init__(parent)
+        self.nodes = LazyNodes(self, source, index.nodes)
+        self._source = source
+        self._variations = index.variations
+
+    @property
+    def children(self):
+        if self._variations is not None:
+            start, end = self._variations
+            self._variations = None
+            # let Tauber's callbacks plug the variations to this tree, as if they had been parsed along with it
+            self.parser = Parser()
+            self.setup()
+            self.parser.parse(self._source.text(start, end))
+            self.parser = None
+        return self._children
+
+    @children.setter
+    def children(self, value):
+        self._children = value
+
+    def materialize(self):
+        """ Decode all nodes and variations, and stop using the source file.
+        """
+        self.nodes.materialize()
+        _ = self.children
+        self._source = None
+
+
+class LazyNodes(list):
+    """ The nodes sequence of a LazyGameTreeGl.
+
+    Not yet decoded nodes are stored as (start, end) offsets. Decoding has to be done in sequence since the move number
+    of a node may depend on its previous node, so that accessing a node decodes all the nodes before it.
+    """
+
+    def __init__(self, tree, source, bounds):
+        super().__init__(zip(bounds[:-1], bounds[1:]))
+        self.tree = tree
+        self.source = source
+        self.decoded = 0  # the number of nodes decoded from the beginning of the sequence
+
+    def decode(self, upto):
+        """ Decode all nodes up to index "upto", inclusive.
+        """
+        previous = list.__getitem__(self, self.decoded - 1) if self.decoded else None
+        for i in range(self.decoded, upto + 1):
+            item = list.__getitem__(self, i)
+            if type(item) is tuple:
+                item = self._decode_node(previous, *item)
+                list.__setitem__(self, i, item)
+            previous = item
+        self.decoded = max(self.decoded, upto + 1)
+
+    def materialize(self):
+        self.decode(len(self) - 1)
+        self.source = None
+
+    def _decode_node(self, previous, start, end):
+        node = NodeGl(self.tree, previous)
+        ident = None
+        for kind, text in tokens(self.source.text(start, end), 1):  # skip the leading ';'
+            if kind == IDENT:
+                if ident is not None:
+                    node.my_end_property()
+                ident = text
+                node.my_start_property(ident)
+            elif kind == VALUE and ident is not None:
+                node.my_add_prop_value(text)
+            else:
+                raise sgf.ParseException(text, start)
+        if ident is not None:
+            node.my_end_property()
+        node.number()
+        return node
+
+    def __getitem__(self, item):
+        if type(item) is slice:
+            self.decode(len(self) - 1)
+        else:
+            idx = item if 0 <= item else len(self) + item
+            if self.decoded <= idx < len(self):
+                self.decode(idx)
+        return list.__getitem__(self, item)
+
+    def __iter__(self):
+        i = 0
+        while i < len(self):
+            yield self[i]
+            i += 1
+
+
 class NodeGl(sgf.Node):
+    # the Move decoded from the properties, see getmove(). Instances override this class-level default
+    _move = _UNDECODED
+
     def my_end_property(self):
         if self.current_property == 'MN':
             value = [int(self.current_prop_value[0])]
@@ -79,6 +427,7 @@ class NodeGl(sgf.Node):
         # if number provided, force update
         if 0 <= nb:
             self.properties["MN"] = [nb]
+            self._move = _UNDECODED
 
         # else create number only if it is missing
         elif "MN" not in self.properties.keys():
@@ -93,13 +442,29 @@ class NodeGl(sgf.Node):
             except golib.model.SgfWarning:  # previous is not a move, don't increment
                 pass
             self.properties["MN"] = [number]
+            self._move = _UNDECODED
+
+    def invalidate(self):
+        """ Forget the Move cached by getmove(). Must be called after any change to the move properties of this node
+        (B, W, MN), unless made through number().
+        """
+        self._move = _UNDECODED
 
     def getmove(self):
         """
         A.P.
         Returns a Move object, or null if this node has no move property.
 
+        The Move is decoded once and cached until invalidate() is called: it is shared between callers, and must be
+        copied before being modified.
+
         """
+        move = self._move
+        if move is _UNDECODED:
+            move = self._move = self._decode_move()
+        return move
+
+    def _decode_move(self):
         number = -1
         try:
             number = self.properties["MN"][0]
@@ -0,0 +1,276 @@
+import locale
+import mmap
+import re
+
+from golib.model import sgf
+
+
+"""
+Bulk lexing of SGF text.
+
+Tauber's parser inspects the text one character at a time, and builds property values by repeated string
+concatenation. The lexer below matches whole runs of text at once: whitespace and identifiers with a compiled regular
+expression, bracketed values with str.find(). It feeds the same parsing events to the same callbacks.
+
+"""
+
+# punctuation tokens, the value of the token is the punctuation character itself
+PUNCT = "punct"
+# property identifier, with lowercase letters already removed (e.g. "AddBlack" -> "AB")
+IDENT = "ident"
+# property value, with escaping already removed
+VALUE = "value"
+
+WHITESPACE = " \t\r\n"
+
+_token = re.compile(r"[ \t\r\n]*(?:(?P<value>\[)|(?P<ident>[A-Z][A-Za-z]*)(?=\[)|(?P<punct>[(;)]))")
+_escaped = re.compile(r"\\(.)", re.DOTALL)
+_lowercase = re.compile(r"[a-z]+")
+_special = re.compile(r"[()\[\]\\]")
+_bound = re.compile(rb"[;()]|\[(?:[^\\\]]+|\\.)*\]", re.DOTALL)
+
+
+def tokenize(sgf_string, start=0):
+    """ Return a generator of the (kind, text) tokens found in sgf_string, starting at the first opening parenthesis.
+
+    As with Tauber's parser, everything before the first '(' found after "start" is ignored.
+
+    Args:
+        sgf_string: str
+            The text to cut into tokens.
+        start: int
+            The index where to start looking for the first '('.
+    """
+    pos = sgf_string.find('(', start)
+    if pos < 0:
+        raise sgf.ParseException("No game tree found", start)
+    return tokens(sgf_string, pos)
+
+
+def tokens(sgf_string, pos=0):
+    """ Yield the (kind, text) tokens found in sgf_string from index "pos", ignoring trailing whitespace.
+    """
+    end = len(sgf_string.rstrip(WHITESPACE))
+    match = _token.match
+    while pos < end:
+        m = match(sgf_string, pos, end)
+        if m is None:
+            raise sgf.ParseException(sgf_string[pos:pos + 1], pos)
+        kind = m.lastgroup
+        pos = m.end()
+        if kind == VALUE:
+            close = value_end(sgf_string, pos)
+            text = sgf_string[pos:close]
+            if "\\" in text:
+                text = _escaped.sub(r"\1", text)
+            pos = close + 1
+        else:
+            text = m.group(kind)
+            if kind == IDENT and not text.isupper():
+                text = _lowercase.sub("", text)
+        yield kind, text
+
+
+def value_end(sgf_string, start):
+    """ Return the index of the closing bracket of the property value starting at "start" (just after '[').
+    """
+    close = sgf_string.find(']', start)
+    while 0 < close and sgf_string[close - 1] == "\\":
+        # the bracket is escaped if preceded by an odd number of backslashes
+        escape = close - 1
+        while start < escape and sgf_string[escape - 1] == "\\":
+            escape -= 1
+        if not (close - escape) % 2:
+            break
+        close = sgf_string.find(']', close + 1)
+    if close < 0:
+        raise sgf.ParseException("Unterminated property value", start)
+    return close
+
+
+def split_games(f, chunk_size=1 << 16):
+    """ Yield the text of each top-level game tree read from the file object f, as soon as its last ')' has been read.
+
+    Only the game being read is kept in memory. Text found between game trees is ignored.
+
+    Args:
+        f: file object
+            The text stream to read from.
+        chunk_size: int
+            The number of characters to read at once.
+    """
+    parts = []  # pieces of the game tree being read
+    depth = 0
+    in_value = False
+    escaped = False  # the first character of the next chunk is escaped
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        start = 0
+        skip = 0 if escaped else -1
+        escaped = False
+        for m in _special.finditer(chunk):
+            i = m.start()
+            if i == skip:
+                continue
+            ch = chunk[i]
+            if in_value:
+                if ch == "\\":
+                    if i + 1 < len(chunk):
+                        skip = i + 1
+                    else:
+                        escaped = True
+                elif ch == "]":
+                    in_value = False
+            elif ch == "(":
+                if not depth:
+                    start = i
+                depth += 1
+            elif not depth:
+                continue  # outside of any game tree
+            elif ch == "[":
+                in_value = True
+            elif ch == ")":
+                depth -= 1
+                if not depth:
+                    parts.append(chunk[start:i + 1])
+                    yield "".join(parts)
+                    parts = []
+                    start = i + 1
+        if depth:
+            parts.append(chunk[start:])
+    if depth:
+        raise sgf.ParseException("Unterminated game tree", depth)
+
+
+class GameIndex:
+    """ Byte offsets of the main elements of a top-level game tree.
+
+    Attributes:
+        start, end: int
+            The offsets of the opening and (past the) closing parentheses of the game tree.
+        nodes: list
+            The offsets where each node of the game tree's sequence starts, plus the offset where the last node ends.
+        variations: tuple
+            The (start, end) offsets of the text holding all the sub game trees, or None if there are none.
+    """
+
+    def __init__(self, start):
+        self.start = start
+        self.end = None
+        self.nodes = []
+        self.variations = None
+
+
+class MappedSource:
+    """ Read-only view of an SGF file, mapped in memory.
+    """
+
+    def __init__(self, filepath, encoding=None):
+        self.encoding = encoding if encoding is not None else locale.getpreferredencoding(False)
+        with open(filepath, 'rb') as f:
+            try:
+                self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # empty file, mmap needs at least one byte
+                raise sgf.ParseException("No game tree found", filepath)
+
+    def text(self, start, end):
+        return self.buffer[start:end].decode(self.encoding)
+
+    def index(self):
+        """ Return the GameIndex of each top-level game tree.
+
+        Only the delimiters are inspected, property values are skipped without being decoded. Since delimiters are
+        looked for as bytes, the file encoding has to be ASCII-compatible (e.g. UTF-8, Latin-1).
+        """
+        games = []
+        game = None
+        depth = 0
+        for m in _bound.finditer(self.buffer):
+            pos = m.start()
+            ch = self.buffer[pos]
+            if ch == 59:  # ';'
+                if depth == 1 and game.variations is None:
+                    game.nodes.append(pos)
+            elif ch == 40:  # '('
+                depth += 1
+                if depth == 1:
+                    game = GameIndex(pos)
+                    games.append(game)
+                elif depth == 2 and game.variations is None:
+                    game.nodes.append(pos)
+                    game.variations = pos
+            elif ch == 41 and depth:  # ')'
+                if depth == 1:
+                    if game.variations is None:
+                        game.nodes.append(pos)
+                    else:
+                        game.variations = (game.variations, pos)
+                    game.end = pos + 1
+                depth -= 1
+        if not games or depth:
+            raise sgf.ParseException("Incomplete game tree", len(self.buffer))
+        return games
+
+
+class LexParser(sgf.Parser):
+    """ Drop-in replacement of Tauber's Parser, using tokenize() instead of the character-level state machine.
+
+    The same callbacks are triggered in the same order, so that the objects built are identical.
+    """
+
+    def parse(self, sgf_string):
+        # states, named after their equivalent in sgf.Parser:
+        # 1 after '(', 2 in a node, 3 after a property identifier, 7 after a property value, 4 after ')'
+        state = 4
+        # nesting is only counted: the game trees themselves keep track of their parent (see sgf.GameTree.setup())
+        depth = 0
+        for kind, text in tokenize(sgf_string):
+            if kind == VALUE:
+                if state == 3 or state == 7:
+                    self.add_prop_value(text)
+                    state = 7
+                else:
+                    raise sgf.ParseException("[" + text + "]", state)
+            elif kind == IDENT:
+                if state == 7:
+                    self.end_property()
+                elif state != 2:
+                    raise sgf.ParseException(text, state)
+                self.start_property(text)
+                state = 3
+            elif text == ";":
+                if state == 7:
+                    self.end_property()
+                    self.end_node()
+                elif state == 2:
+                    self.end_node()
+                elif state != 1:
+                    raise sgf.ParseException(text, state)
+                self.start_node()
+                state = 2
+            elif text == "(":
+                if state == 7:
+                    self.end_property()
+                    self.end_node()
+                elif state == 2:
+                    self.end_node()
+                elif state != 4:
+                    raise sgf.ParseException(text, state)
+                self.start_gametree()
+                depth += 1
+                state = 1
+            else:  # ')'
+                if state == 7:
+                    self.end_property()
+                    self.end_node()
+                elif state == 2:
+                    self.end_node()
+                elif state != 4 or not depth:
+                    raise sgf.ParseException(text, state)
+                self.end_gametree()
+                depth -= 1
+                state = 4
+        if state != 4:
+            raise sgf.ParseException("Unexpected end of input", state)
@@ -0,0 +1,230 @@
+import random
+
+
+"""
+Index of the moves of a line of play by intersection, for Kifu.locate() and Kifu.contains_pos().
+
+The index does not store the numbers of the moves, which would have to be rewritten after each insert or delete.
+The order of the moves is held by a treap instead: a binary tree balanced by random priorities, where each item knows
+the size of its subtree. The rank of a move in the line (its number, give or take the number of the first move) is
+found by walking up from its item to the root, and an insert or a delete only updates the sizes on one path.
+
+"""
+
+_random = random.Random()
+
+
+class _Item:
+    """ The item of one move in the treap.
+    """
+
+    __slots__ = ("node", "spot", "priority", "left", "right", "parent", "size")
+
+    def __init__(self, node, spot):
+        self.node = node
+        self.spot = spot
+        self.priority = _random.random()
+        self.left = None
+        self.right = None
+        self.parent = None
+        self.size = 1
+
+
+def _size(item):
+    return item.size if item is not None else 0
+
+
+class SpotIndex:
+    """ The nodes holding the moves of a line of play, by intersection, in the order of the line.
+
+    Inserts, deletes and ranks take O(log n) expected time, n being the number of moves. Searching the moves of one
+    intersection takes O(log n * log m), m being the number of moves played there.
+    """
+
+    def __init__(self, nodes, coords):
+        """
+        Args:
+            nodes: list
+                The nodes holding a move, in the order of the line.
+            coords: callable
+                Return the intersection (x, y) of the move held by a node.
+        """
+        self.coords = coords
+        self._items = {}  # node -> _Item
+        self._spots = {}  # (x, y) -> the nodes of the moves played there, in the order of the line
+        self._root = None
+        # build the Cartesian tree of the priorities in O(n), the stack holding its right spine
+        spine = []
+        for node in nodes:
+            item = self._item(node)
+            self._spots.setdefault(item.spot, []).append(node)
+            last = None
+            while spine and spine[-1].priority < item.priority:
+                last = spine.pop()
+            if last is not None:
+                item.left = last
+                last.parent = item
+            if spine:
+                spine[-1].right = item
+                item.parent = spine[-1]
+            spine.append(item)
+        if spine:
+            self._root = spine[0]
+            # compute the sizes, children before parents
+            order = []
+            stack = [self._root]
+            while stack:
+                item = stack.pop()
+                order.append(item)
+                stack.extend(child for child in (item.left, item.right) if child is not None)
+            for item in reversed(order):
+                item.size = _size(item.left) + _size(item.right) + 1
+
+    def __len__(self):
+        return _size(self._root)
+
+    def rank(self, node):
+        """ Return the index of the node in the line.
+        """
+        item = self._items[node]
+        rank = _size(item.left)
+        while item.parent is not None:
+            if item.parent.right is item:
+                rank += _size(item.parent.left) + 1
+            item = item.parent
+        return rank
+
+    def insert(self, rank, node):
+        """ Insert the node at index "rank" of the line.
+        """
+        item = self._item(node)
+        if self._root is None:
+            self._root = item
+        else:
+            current = self._root
+            while True:
+                current.size += 1
+                left = _size(current.left)
+                if rank <= left:
+                    if current.left is None:
+                        current.left = item
+                        break
+                    current = current.left
+                else:
+                    rank -= left + 1
+                    if current.right is None:
+                        current.right = item
+                        break
+                    current = current.right
+            item.parent = current
+            while item.parent is not None and item.parent.priority < item.priority:
+                self._rotate_up(item)
+        self._enlist(node, item.spot)
+
+    def append(self, node):
+        self.insert(len(self), node)
+
+    def remove(self, node):
+        """ Remove the node from the index.
+        """
+        self._unlist(node, self._items[node].spot)
+        item = self._items.pop(node)
+        while item.left is not None or item.right is not None:
+            left, right = item.left, item.right
+            self._rotate_up(left if right is None or (left is not None and right.priority < left.priority) else right)
+        parent = item.parent
+        if parent is None:
+            self._root = None
+        elif parent.left is item:
+            parent.left = None
+        else:
+            parent.right = None
+        while parent is not None:
+            parent.size -= 1
+            parent = parent.parent
+
+    def respot(self, node):
+        """ Update the intersection of the node, after its move has been changed in place.
+        """
+        item = self._items[node]
+        spot = self.coords(node)
+        if spot != item.spot:
+            self._unlist(node, item.spot)
+            item.spot = spot
+            self._enlist(node, spot)
+
+    def last(self, spot, upbound=None):
+        """ Return the rank of the last move played on the intersection, among the moves of rank upbound or less if
+        provided. Return None if there is no such move.
+        """
+        nodes = self._spots.get(spot)
+        if nodes:
+            k = len(nodes) if upbound is None else self._bisect(nodes, upbound + 1)
+            if k:
+                return self.rank(nodes[k - 1])
+
+    def first(self, spot, start=0):
+        """ Return the rank of the first move played on the intersection, among the moves of rank start or more.
+        Return None if there is no such move.
+        """
+        nodes = self._spots.get(spot)
+        if nodes:
+            k = self._bisect(nodes, start)
+            if k < len(nodes):
+                return self.rank(nodes[k])
+
+    def _item(self, node):
+        item = self._items[node] = _Item(node, self.coords(node))
+        return item
+
+    def _bisect(self, nodes, rank):
+        """ Return the index of the first node of the list whose rank is greater than or equal to rank.
+        """
+        lo, hi = 0, len(nodes)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.rank(nodes[mid]) < rank:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _enlist(self, node, spot):
+        """ Add the node to the moves of the intersection, at the place given by its rank.
+        """
+        nodes = self._spots.setdefault(spot, [])
+        nodes.insert(self._bisect(nodes, self.rank(node)), node)
+
+    def _unlist(self, node, spot):
+        """ Remove the node from the moves of the intersection.
+        """
+        nodes = self._spots[spot]
+        del nodes[self._bisect(nodes, self.rank(node))]
+        if not nodes:
+            del self._spots[spot]
+
+    def _rotate_up(self, item):
+        """ Swap the item with its parent, keeping the order of the line.
+        """
+        parent = item.parent
+        grand = parent.parent
+        if parent.left is item:
+            parent.left = item.right
+            if item.right is not None:
+                item.right.parent = parent
+            item.right = parent
+        else:
+            parent.right = item.left
+            if item.left is not None:
+                item.left.parent = parent
+            item.left = parent
+        parent.parent = item
+        item.parent = grand
+        if grand is None:
+            self._root = item
+        elif grand.left is parent:
+            grand.left = item
+        else:
+            grand.right = item
+        item.size = parent.size
+        parent.size = _size(parent.left) + _size(parent.right) + 1